@@ -0,0 +1,68 @@
+"""Frames/s and peak memory of the analysis kernels on synthetic trajectories."""
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from benchmarks.synthetic import load_config, synthetic_com_heights, synthetic_trajectory
+
+def measure(fn, *args):
+    """Times one call, then repeats it under tracemalloc for the peak allocation
+    (tracing slows numpy down, so the two are kept separate)."""
+    start = time.perf_counter()
+    fn(*args)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    fn(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return elapsed, peak
+
+def kernels():
+    import ribose_analysis
+
+    return {
+        'compute_heights': ribose_analysis.compute_heights,
+        'compute_hbonds': lambda traj: ribose_analysis.compute_hbonds(traj, {}),
+        'nematic_order': ribose_analysis.nematic_order,
+        'sasa': ribose_analysis.sasa,
+    }
+
+def bench_kernels(sizes, n_sugars):
+    results = {}
+    for n_frames in sizes:
+        traj = synthetic_trajectory(n_frames, n_sugars)
+        for name, fn in kernels().items():
+            elapsed, peak = measure(fn, traj)
+            results.setdefault(name, {})[str(n_frames)] = {
+                'seconds': elapsed,
+                'frames/s': n_frames / elapsed,
+                'peak MB': peak / 2**20,
+            }
+    return results
+
+def bench_wham(sizes, n_windows=16):
+    import umbrella
+
+    results = {}
+    targets = np.linspace(0.35, 1.1, n_windows, endpoint=False)
+    for samples in sizes:
+        with tempfile.TemporaryDirectory() as outdir:
+            synthetic_com_heights(outdir, targets, samples)
+            config = load_config('umbrella_config.ini', {'Output Parameters': {'outdir': outdir}, 'Umbrella Setup': {'wham cuda': 'False'}})
+            elapsed, peak = measure(umbrella.wham, 'D', config)
+
+        results[str(samples * n_windows)] = {
+            'seconds': elapsed,
+            'frames/s': samples * n_windows / elapsed,
+            'peak MB': peak / 2**20,
+        }
+    return results
+
+def run(sizes=(50, 200, 1000), n_sugars=6):
+    results = bench_kernels(sizes, n_sugars)
+    results['wham'] = bench_wham([size * 10 for size in sizes])
+    return results
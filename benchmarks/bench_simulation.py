@@ -0,0 +1,79 @@
+"""Setup time and ns/day of short sheet and umbrella simulations on a CPU platform."""
+import time
+
+from benchmarks.synthetic import load_config
+from profiling import PhaseTimer
+
+def time_call(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return result, time.perf_counter() - start
+
+def ns_per_day(simulation, steps):
+    from openmm.unit import nanosecond
+
+    # the first steps include kernel compilation, keep them out of the measurement
+    simulation.step(10)
+    start = time.perf_counter()
+    simulation.step(steps)
+    elapsed = time.perf_counter() - start
+
+    dt = simulation.integrator.getStepSize().value_in_unit(nanosecond)
+    return steps * dt / elapsed * 86400
+
+def setup_phases(first_load, build, timer):
+    setup = {'first load_mols': first_load, 'build total': build}
+    setup.update({name: record['wall s'] for name, record in timer.phases.items()})
+    return setup
+
+def bench_sheet(platform, steps, n_mols):
+    import ribose_sheet
+
+    config = load_config('sheet_config.ini', {
+        'Sheet Setup': {'num of each mol': n_mols},
+        'Simulation Setup': {'platform': platform, 'threads': ''},
+        'Output Parameters': {'verbose': 'False'},
+    })
+    names = config.get('Sheet Setup','test molecules').split(',')
+    resnames = config.get('Sheet Setup','test resnames').split(',')
+
+    # the first load fills the molecule cache, build_simulation then reports the cached load time
+    _, first_load = time_call(ribose_sheet.load_test_mols, names, resnames)
+    timer = PhaseTimer()
+    (simulation, _, _), build = time_call(ribose_sheet.build_simulation, 0, 0, config, timer)
+
+    return {
+        'atoms': simulation.system.getNumParticles(),
+        'setup s': setup_phases(first_load, build, timer),
+        'ns/day': ns_per_day(simulation, steps),
+    }
+
+def bench_umbrella(platform, steps):
+    import umbrella
+
+    config = load_config('umbrella_config.ini', {
+        'Simulation Parameters': {'platform': platform, 'threads': ''},
+        'Umbrella Setup': {'warm start': 'False'},
+        'Output Parameters': {'verbose': 'False'},
+    })
+    start_z = float(config.get('Umbrella Setup','start z'))
+    end_z = float(config.get('Umbrella Setup','end z'))
+
+    _, first_load = time_call(umbrella.load_mols, ["aD-ribopyro.sdf", 'aL-ribopyro.sdf', 'guanine.sdf', 'cytosine.sdf'],
+                              ['DRIB', 'LRIB', 'GUA', "CYT"])
+    timer = PhaseTimer()
+    (simulation, _, _), build = time_call(umbrella.build_simulation, 0, 0, start_z, end_z, 'D', config, timer)
+
+    return {
+        'atoms': simulation.system.getNumParticles(),
+        'setup s': setup_phases(first_load, build, timer),
+        'ns/day': ns_per_day(simulation, steps),
+    }
+
+def run(platform='CPU', steps=500, n_mols=2):
+    return {
+        'platform': platform,
+        'steps': steps,
+        'sheet': bench_sheet(platform, steps, n_mols),
+        'umbrella': bench_umbrella(platform, steps),
+    }
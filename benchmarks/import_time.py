@@ -0,0 +1,64 @@
+"""Import-time report for the entry points.
+
+Runs each module in a fresh interpreter with `-X importtime` and reports the total import
+time and the slowest top-level packages, plus the wall time of `cli.py --help`.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODULES = ['cli', 'ribose_sheet', 'umbrella', 'ribose_analysis']
+
+def parse_importtime(stderr):
+    """Returns {package: cumulative seconds} for the top-level packages in an -X importtime log."""
+    packages = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        # top-level imports follow the bar after exactly one space, nested ones are indented
+        # further, only keep the outermost so times are not counted twice
+        if not name.startswith('  '):
+            name = name.strip()
+            packages[name] = packages.get(name, 0) + int(cumulative) / 1e6
+    return packages
+
+def time_import(module):
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=REPO, capture_output=True, text=True)
+    packages = parse_importtime(result.stderr)
+    return {
+        'ok': result.returncode == 0,
+        'total s': sum(packages.values()),
+        'slowest': dict(sorted(packages.items(), key=lambda item: -item[1])[:10]),
+    }
+
+def time_help():
+    start = time.perf_counter()
+    subprocess.run([sys.executable, 'cli.py', '--help'], cwd=REPO, capture_output=True)
+    return time.perf_counter() - start
+
+def run():
+    report = {module: time_import(module) for module in MODULES}
+    report['cli --help wall s'] = time_help()
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--output', default='import_time.json')
+    args = parser.parse_args()
+
+    report = run()
+    for module in MODULES:
+        print(f"{module:16s} {report[module]['total s']:6.2f} s")
+    print(f"cli.py --help    {report['cli --help wall s']:6.2f} s")
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+if __name__ == '__main__':
+    main()
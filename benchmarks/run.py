@@ -0,0 +1,72 @@
+"""Runs the benchmark suite and saves the results as JSON.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --output new.json --compare old.json
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import subprocess
+
+from benchmarks import bench_analysis, bench_simulation, import_time
+from benchmarks.synthetic import REPO
+
+def git_version():
+    result = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=REPO, capture_output=True, text=True)
+    return result.stdout.strip() or 'unknown'
+
+def flatten(results, prefix=''):
+    flat = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}/'))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[f'{prefix}{key}'] = value
+    return flat
+
+def compare(old, new):
+    """Prints every numeric result present in both runs with its new/old ratio."""
+    old, new = flatten(old['results']), flatten(new['results'])
+    for key in sorted(old.keys() & new.keys()):
+        ratio = new[key] / old[key] if old[key] else float('nan')
+        print(f'{key:70s} {old[key]:12.4g} {new[key]:12.4g} {ratio:8.2f}x')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulation and analysis benchmarks')
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--compare', metavar='OLD_JSON', help='print ratios against an earlier result file')
+    parser.add_argument('--platform', default='CPU', help='OpenMM platform for the simulation benchmarks (CPU or Reference)')
+    parser.add_argument('--steps', type=int, default=500)
+    parser.add_argument('--frames', type=int, nargs='+', default=[50, 200, 1000])
+    parser.add_argument('--skip-simulation', action='store_true')
+    parser.add_argument('--skip-analysis', action='store_true')
+    args = parser.parse_args(argv)
+
+    # the simulation code loads molecules relative to the repo root
+    os.chdir(REPO)
+
+    results = {'imports': import_time.run()}
+    if not args.skip_simulation:
+        results['simulation'] = bench_simulation.run(args.platform, args.steps)
+    if not args.skip_analysis:
+        results['analysis'] = bench_analysis.run(args.frames)
+
+    report = {
+        'version': git_version(),
+        'date': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'Saved benchmark results to {args.output}')
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+
+if __name__ == '__main__':
+    main()
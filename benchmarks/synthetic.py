@@ -0,0 +1,87 @@
+"""Small synthetic systems and trajectories built from the SDFs in molecules/."""
+import configparser
+import os
+
+import numpy as np
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# (sdf, residue name) of the sheet and the sugars in the synthetic trajectories
+SHEET_MOLS = [('guanine.sdf', 'G'), ('cytosine.sdf', 'C')]
+SUGAR_MOLS = [('aD-ribopyro.sdf', 'DRI'), ('aL-ribopyro.sdf', 'LRI')]
+
+def load_config(filename, overrides):
+    """Reads one of the repo configs and applies {section: {key: value}} overrides."""
+    config = configparser.ConfigParser()
+    config.read(os.path.join(REPO, filename))
+    for section, values in overrides.items():
+        if not config.has_section(section):
+            config.add_section(section)
+        for key, value in values.items():
+            config.set(section, key, str(value))
+    return config
+
+def molecule_topology(filename, resname):
+    import mdtraj as md
+    from openmm.unit import nanometer
+    from mol_cache import load_molecule
+
+    mol = load_molecule(os.path.join(REPO, 'molecules', filename), resname)
+    top = md.Topology.from_openmm(mol['topology'])
+    xyz = np.asarray(mol['positions'].value_in_unit(nanometer))
+    return top, xyz - xyz.mean(axis=0)
+
+def synthetic_trajectory(n_frames, n_sugars, sheet_size=4, box=(3.5, 3.5, 7.0), seed=0):
+    """Builds a sheet of sheet_size x sheet_size guanine/cytosine molecules at z = 1 nm with
+    n_sugars of each enantiomer diffusing above it.
+    Params
+    ======
+    n_frames   (int)
+    n_sugars   (int) - number of D- and of L-ribose molecules
+    sheet_size (int) - molecules per side of the sheet
+    box        (tuple) - orthorhombic box lengths in nm
+
+    Returns
+    =======
+    traj (md.Trajectory)"""
+    import mdtraj as md
+
+    rng = np.random.default_rng(seed)
+    sheet = [molecule_topology(f, r) for f, r in SHEET_MOLS]
+    sugars = [molecule_topology(f, r) for f, r in SUGAR_MOLS]
+
+    top = md.Topology()
+    frames = []
+    for i in range(sheet_size):
+        for j in range(sheet_size):
+            mol_top, mol_xyz = sheet[(i + j) % 2]
+            top = top.join(mol_top)
+            center = np.array([(i + 0.5) * box[0] / sheet_size, (j + 0.5) * box[1] / sheet_size, 1.0])
+            frames.append(np.broadcast_to(mol_xyz + center, (n_frames,) + mol_xyz.shape))
+
+    for mol_top, mol_xyz in sugars:
+        for _ in range(n_sugars):
+            top = top.join(mol_top)
+            start = rng.uniform([0, 0, 1.3], [box[0], box[1], box[2] - 1])
+            walk = np.cumsum(rng.normal(scale=0.02, size=(n_frames, 3)), axis=0)
+            walk[:, 2] = np.clip(start[2] + walk[:, 2], 1.3, box[2] - 0.5) - start[2]
+            frames.append(mol_xyz[None] + (start + walk)[:, None])
+
+    xyz = np.concatenate(frames, axis=1).astype(np.float32)
+    xyz += rng.normal(scale=0.005, size=xyz.shape).astype(np.float32)
+
+    return md.Trajectory(xyz, top,
+                         time=np.arange(n_frames) * 4.0,
+                         unitcell_lengths=np.tile(box, (n_frames, 1)),
+                         unitcell_angles=np.full((n_frames, 3), 90.0))
+
+def synthetic_com_heights(outdir, targets, samples, ribose_type='D', bias_k=5000, seed=0):
+    """Writes com_heights files and the target list as umbrella.wham expects them."""
+    from umbrella import com_file, save_com
+
+    rng = np.random.default_rng(seed)
+    kbT = 2.494
+    for target in targets:
+        heights = rng.normal(target, np.sqrt(kbT / bias_k), size=samples)
+        save_com(com_file(outdir, target, ribose_type), np.zeros(samples, dtype=int), heights)
+    np.savetxt(f'{outdir}/heights_{ribose_type}.csv', targets)
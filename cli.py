@@ -0,0 +1,86 @@
+"""Single entry point for the sheet simulations, umbrella sampling and trajectory analysis.
+
+Each subcommand imports the module it runs only once it has been selected, so `--help`
+and argument errors never load OpenMM, OpenFF, mdtraj or matplotlib.
+"""
+import argparse
+
+def run_sheet(args):
+    import ribose_sheet
+    ribose_sheet.main(args.config)
+
+def run_sweep(args):
+    import sweep
+    sweep.main(args.config)
+
+def run_umbrella(args):
+    import umbrella
+    umbrella.main(args.config, args.benchmark_packing)
+
+def run_analysis(args):
+    import ribose_analysis
+    ribose_analysis.main(args.config)
+
+def run_energies(args):
+    import energy_decomposition
+    energy_decomposition.main(args.config)
+
+def run_compact(args):
+    import trajstore
+    for dcd in args.dcd:
+        prefix = f"{dcd.rsplit('.', 1)[0]}.solute"
+        n_frames = trajstore.compact(dcd, args.top, prefix, args.selection)
+        print(f'{dcd}: {n_frames} frames -> {prefix}.*')
+
+def run_benchmarks(args):
+    from benchmarks import run
+    run.main(args.extra)
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='cli.py', description='Ribose enantiomers on a guanine-cytosine sheet')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    sheet = subparsers.add_parser('sheet', help='simulate sugars above the sheet')
+    sheet.add_argument('--config', default='sheet_config.ini')
+    sheet.set_defaults(func=run_sheet)
+
+    sweep = subparsers.add_parser('sweep', help='run a parameter grid of sheet simulations')
+    sweep.add_argument('--config', default='sweep_config.ini')
+    sweep.set_defaults(func=run_sweep)
+
+    umbrella = subparsers.add_parser('umbrella', help='umbrella sampling of a single sugar and WHAM')
+    umbrella.add_argument('--config', default='umbrella_config.ini')
+    umbrella.add_argument('--benchmark-packing', type=int, metavar='N',
+                          help='measure throughput of 1..N concurrent windows per gpu and exit')
+    umbrella.set_defaults(func=run_umbrella)
+
+    analyze = subparsers.add_parser('analyze', help='analyze sheet trajectories')
+    analyze.add_argument('--config', default='analysis_config.ini')
+    analyze.set_defaults(func=run_analysis)
+
+    energies = subparsers.add_parser('energies', help='decompose sugar interaction energies of sheet trajectories')
+    energies.add_argument('--config', default='analysis_config.ini')
+    energies.set_defaults(func=run_energies)
+
+    compact = subparsers.add_parser('compact', help='convert dcds to memory mapped solute-only stores')
+    compact.add_argument('dcd', nargs='+')
+    compact.add_argument('--top', required=True, help='topology (pdb) of the full system')
+    compact.add_argument('--selection', default='not water', help='mdtraj selection of the atoms to keep')
+    compact.set_defaults(func=run_compact)
+
+    bench = subparsers.add_parser('bench', add_help=False, help='run the benchmark suite, see cli.py bench --help')
+    bench.set_defaults(func=run_benchmarks)
+
+    return parser
+
+def main(argv=None):
+    parser = build_parser()
+    # options after 'bench' belong to the benchmark runner's own parser
+    args, extra = parser.parse_known_args(argv)
+    args.extra = extra
+    if args.extra and args.command != 'bench':
+        parser.error(f"unrecognized arguments: {' '.join(args.extra)}")
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
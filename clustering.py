@@ -0,0 +1,188 @@
+"""Sugar aggregation: periodic neighbor search, connected clusters and their D/L makeup.
+
+Neighbors are found with a k-d tree (scipy cKDTree), which bins the points into cells
+like a cell list, so no all-pairs distance matrix is ever built. A whole chunk is
+searched at once by laying the frames out along a fourth axis, further apart than the
+cutoff, and clusters are connected components of the neighbor graph, found with a
+vectorized union-find over every (frame, sugar) node of the chunk.
+"""
+import numpy as np
+
+from topology_registry import SHEET, SUGARS
+
+def orthorhombic_box(traj):
+    """Box lengths shared by every frame of the chunk, None without a box. Returns False
+    when the box changes within the chunk and frames have to be searched one by one."""
+    if traj.unitcell_lengths is None:
+        return None
+    if not np.allclose(traj.unitcell_angles, 90):
+        raise ValueError('Clustering supports orthorhombic boxes only')
+    lengths = traj.unitcell_lengths
+    return lengths[0] if np.allclose(lengths, lengths[0]) else False
+
+def neighbor_pairs(points, box, cutoff):
+    """Pairs of points closer than cutoff within each frame, minimum image when box is given.
+    Params
+    ======
+    points (np.ndarray) - (n_frames, n, 3)
+    box    (np.ndarray) - (3,) orthorhombic box lengths or None
+    cutoff (float)
+
+    Returns
+    =======
+    frame, i, j (np.ndarray) - frame and point indices of every pair, i < j"""
+    from scipy.spatial import cKDTree
+
+    n_frames, n, _ = points.shape
+    if n_frames == 0 or n < 2:
+        return (np.empty(0, dtype=int),) * 3
+
+    spacing = 2 * cutoff
+    frame_axis = np.repeat(np.arange(n_frames) * spacing, n)[:, None]
+    flat = points.reshape(-1, 3)
+    if box is None:
+        tree = cKDTree(np.hstack([flat, frame_axis]))
+    else:
+        box = np.asarray(box, dtype=float)
+        wrapped = np.mod(flat, box)
+        # rounding can put a point exactly on the upper edge, which cKDTree rejects
+        wrapped[wrapped >= box] = 0
+        tree = cKDTree(np.hstack([wrapped, frame_axis]), boxsize=np.append(box, n_frames * spacing))
+
+    pairs = tree.query_pairs(cutoff, output_type='ndarray')
+    return pairs[:, 0] // n, pairs[:, 0] % n, pairs[:, 1] % n
+
+def chunk_pairs(points, traj, cutoff):
+    box = orthorhombic_box(traj)
+    if box is not False:
+        return neighbor_pairs(points, box, cutoff)
+
+    # the box changes (barostat), search frame by frame
+    found = [neighbor_pairs(points[f:f+1], traj.unitcell_lengths[f], cutoff) for f in range(len(points))]
+    return tuple(np.concatenate([pairs[k] + (f if k == 0 else 0) for f, pairs in enumerate(found)]) for k in range(3))
+
+def connected_components(n_nodes, i, j):
+    """Component label of every node of the graph with edges (i, j). Every node hooks to the
+    smallest label among its neighbors and labels are shortcut by pointer jumping until
+    nothing changes, so the work is a few numpy passes over the edges."""
+    labels = np.arange(n_nodes)
+    while True:
+        previous = labels
+        labels = labels.copy()
+        np.minimum.at(labels, i, labels[j])
+        np.minimum.at(labels, j, labels[i])
+        labels = labels[labels]
+        if np.array_equal(labels, previous):
+            return labels
+
+def sugar_pairs(traj, registry, cutoff, mode):
+    """Neighboring sugar residues (indices into registry.residues(*SUGARS)) in every frame."""
+    residues = registry.residues(*SUGARS)
+    if mode == 'com':
+        return chunk_pairs(registry.residue_centers(traj.xyz, *SUGARS), traj, cutoff)
+
+    # closest atoms: atom pairs across different residues, reduced to unique residue pairs
+    atoms = registry.atoms(*SUGARS)
+    local = np.searchsorted(residues, registry.atom_residue[atoms])
+    frame, a, b = chunk_pairs(traj.xyz[:, atoms], traj, cutoff)
+    i, j = local[a], local[b]
+    keep = i != j
+    keys = np.unique((frame[keep] * len(residues) + np.minimum(i[keep], j[keep])) * len(residues) + np.maximum(i[keep], j[keep]))
+    return keys // len(residues)**2, keys // len(residues) % len(residues), keys % len(residues)
+
+def cluster_sugars(traj, registry, cutoff=0.6, mode='com', sheet_cutoff=0.5):
+    """Per-frame aggregation metrics of the sugars of one chunk.
+    Params
+    ======
+    traj         (md.Trajectory)
+    registry     (topology_registry.TopologyRegistry)
+    cutoff       (float) - nm, neighbor distance between sugar centers of mass (mode 'com') or
+                           between their closest atoms (mode 'atoms')
+    sheet_cutoff (float) - nm, a sugar center of mass this close to the mean sheet height is on the sheet
+
+    Returns
+    =======
+    metrics (dict) - {(metric, group): (n_frames,) array}
+        largest cluster / sugar         - sugars in the largest cluster
+        clusters / sugar                - clusters of two or more sugars
+        clustered fraction / DRI, LRI   - fraction of the sugars in a cluster
+        mixed fraction / sugar          - fraction of the clustered sugars whose cluster holds both enantiomers
+        DL contact fraction / sugar     - fraction of sugar contacts between a D- and an L-ribose
+        on sheet / DRI, LRI             - fraction of the sugars on the sheet"""
+    residues = registry.residues(*SUGARS)
+    n_frames, n = traj.n_frames, len(residues)
+    if n == 0:
+        return {}
+
+    is_d = registry.residue_class[residues] == registry.class_index('DRI')
+    frame, i, j = sugar_pairs(traj, registry, cutoff, mode)
+
+    # nodes are (frame, sugar), so one union-find covers the whole chunk
+    labels = connected_components(n_frames * n, frame * n + i, frame * n + j)
+    sizes = np.bincount(labels, minlength=n_frames * n)
+    node_size = sizes[labels].reshape(n_frames, n)
+    clustered = node_size > 1
+    roots = (labels == np.arange(n_frames * n)).reshape(n_frames, n)
+
+    d_count = np.bincount(labels, weights=np.tile(is_d, n_frames), minlength=n_frames * n)[labels].reshape(n_frames, n)
+    mixed = clustered & (d_count > 0) & (d_count < node_size)
+
+    hetero = is_d[i] != is_d[j]
+    contacts = np.bincount(frame, minlength=n_frames)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        metrics = {
+            ('largest cluster', 'sugar'): node_size.max(axis=1),
+            ('clusters', 'sugar'): (roots & clustered).sum(axis=1),
+            ('mixed fraction', 'sugar'): mixed.sum(axis=1) / clustered.sum(axis=1),
+            ('DL contact fraction', 'sugar'): np.bincount(frame, weights=hetero, minlength=n_frames) / contacts,
+        }
+        for name, members in (('DRI', is_d), ('LRI', ~is_d)):
+            if members.any():
+                metrics['clustered fraction', name] = clustered[:, members].mean(axis=1)
+
+    sheet_atoms = registry.atoms(*SHEET)
+    if len(sheet_atoms):
+        heights = registry.residue_centers(traj.xyz, *SUGARS)[:, :, 2] - traj.xyz[:, sheet_atoms, 2].mean(axis=1)[:, None]
+        if traj.unitcell_lengths is not None:
+            box_z = traj.unitcell_lengths[:, 2:3]
+            heights -= box_z * np.round(heights / box_z)
+        on_sheet = np.abs(heights) < sheet_cutoff
+        for name, members in (('DRI', is_d), ('LRI', ~is_d)):
+            if members.any():
+                metrics['on sheet', name] = on_sheet[:, members].mean(axis=1)
+
+    return metrics
+
+def persistence(traj, registry, stride, start=0):
+    """Persistent homology of the sugar centers of mass in every stride-th frame (ripser). The
+    distance matrix of a frame is only sugars x sugars and only subsampled frames are used.
+    Params
+    ======
+    stride (int) - frames between samples, counted over the whole trajectory
+    start  (int) - frame index of the first frame of the chunk
+
+    Returns
+    =======
+    frames (np.ndarray) - chunk frame indices that were sampled
+    metrics (dict) - {(metric, 'sugar'): array}, total H0 and H1 persistence and the
+                     number of H1 features (rings of sugars)"""
+    from ripser import ripser
+
+    frames = np.arange(-start % stride, traj.n_frames, stride)
+    centers = registry.residue_centers(traj.xyz[frames], *SUGARS)
+    h0, h1, n_h1 = np.zeros(len(frames)), np.zeros(len(frames)), np.zeros(len(frames))
+
+    for k, frame in enumerate(frames):
+        delta = centers[k][:, None] - centers[k][None]
+        if traj.unitcell_lengths is not None:
+            box = traj.unitcell_lengths[frame]
+            delta -= box * np.round(delta / box)
+        diagrams = ripser(np.linalg.norm(delta, axis=-1), distance_matrix=True, maxdim=1)['dgms']
+
+        finite = np.isfinite(diagrams[0][:, 1])
+        h0[k] = np.sum(diagrams[0][finite, 1] - diagrams[0][finite, 0])
+        h1[k] = np.sum(diagrams[1][:, 1] - diagrams[1][:, 0])
+        n_h1[k] = len(diagrams[1])
+
+    return frames, {('H0 persistence', 'sugar'): h0, ('H1 persistence', 'sugar'): h1, ('H1 features', 'sugar'): n_h1}
@@ -0,0 +1,4 @@
+"""Physical constants shared by the custom forces, in OpenMM units."""
+
+# Coulomb constant in kJ/mol nm / e^2, the value OpenMM uses
+ONE_4PI_EPS0 = 138.935456
@@ -0,0 +1,126 @@
+"""Surface density maps of the sugars over the sheet.
+
+DensityMaps keeps, for every sugar class, a 2D (x, y) histogram of the residue centers
+of mass within a set height of the sheet and a 3D (x, y, height) occupancy grid. Both are
+allocated once, so memory does not depend on trajectory length, and maps of different
+chunks or sims are combined with merge(). x and y are binned as fractions of the box so
+the maps line up with the periodic sheet lattice.
+"""
+import numpy as np
+
+from topology_registry import SHEET, SUGARS
+
+class DensityMaps:
+    """Params
+    ======
+    bins              (int) - bins along x and y
+    z_bins            (int) - height bins of the 3D grid
+    adsorption_height (float) - nm, sugars whose center of mass is closer to the sheet than this enter the 2D maps
+    max_height        (float) - nm, top of the 3D grid
+    """
+    def __init__(self, bins=60, z_bins=50, adsorption_height=0.8, max_height=3.0, classes=SUGARS):
+        self.bins = bins
+        self.z_bins = z_bins
+        self.adsorption_height = adsorption_height
+        self.max_height = max_height
+        self.classes = list(classes)
+        self.surface = np.zeros((len(self.classes), bins, bins))
+        self.occupancy = np.zeros((len(self.classes), bins, bins, z_bins))
+        self.n_frames = 0
+        self.box = None
+        self.sheet_xy = np.empty((0, 2))
+
+    def add(self, traj, registry):
+        """Bins the sugar centers of mass of every frame of a chunk."""
+        if traj.unitcell_lengths is None:
+            raise ValueError('Density maps need a periodic box')
+        if self.box is None:
+            self.box = traj.unitcell_lengths[0].astype(float)
+
+        sheet_atoms = registry.atoms(*SHEET)
+        sheet_z = traj.xyz[:, sheet_atoms, 2].mean(axis=1)[:, None] if len(sheet_atoms) else np.zeros((traj.n_frames, 1))
+        if len(sheet_atoms) and not len(self.sheet_xy):
+            # the sheet is restrained, its first frame marks the lattice on the maps
+            self.sheet_xy = np.mod(traj.xyz[0, sheet_atoms, :2] / traj.unitcell_lengths[0, :2], 1)
+
+        box = traj.unitcell_lengths[:, None, :]
+        for k, name in enumerate(self.classes):
+            if not len(registry.residues(name)):
+                continue
+            centers = registry.residue_centers(traj.xyz, name)
+            fractional = np.mod(centers[:, :, :2] / box[:, :, :2], 1)
+            height = centers[:, :, 2] - sheet_z
+            height -= box[:, :, 2] * np.round(height / box[:, :, 2])
+
+            near = np.abs(height) < self.adsorption_height
+            self.surface[k] += np.histogram2d(fractional[near][:, 0], fractional[near][:, 1],
+                                              bins=self.bins, range=[[0, 1], [0, 1]])[0]
+            self.occupancy[k] += np.histogramdd(np.column_stack([fractional.reshape(-1, 2), height.reshape(-1)]),
+                                                bins=(self.bins, self.bins, self.z_bins),
+                                                range=[[0, 1], [0, 1], [0, self.max_height]])[0]
+        self.n_frames += traj.n_frames
+
+    def merge(self, other):
+        """Adds the counts of another DensityMaps with the same bins (e.g. another sim)."""
+        if (other.bins, other.z_bins, other.max_height, other.classes) != (self.bins, self.z_bins, self.max_height, self.classes):
+            raise ValueError('Density maps with different bins cannot be merged')
+        self.surface += other.surface
+        self.occupancy += other.occupancy
+        self.n_frames += other.n_frames
+        if self.box is None:
+            self.box = other.box
+        if not len(self.sheet_xy):
+            self.sheet_xy = other.sheet_xy
+        return self
+
+    def surface_density(self):
+        """Mean number of sugars per nm^2 of every (x, y) bin, classes first."""
+        area = self.box[0] * self.box[1] / self.bins**2
+        return self.surface / (max(self.n_frames, 1) * area)
+
+    def height_profile(self):
+        """Mean number of sugars per nm of height, classes first."""
+        return self.occupancy.sum(axis=(1, 2)) / (max(self.n_frames, 1) * self.max_height / self.z_bins)
+
+    def save(self, filename):
+        np.savez_compressed(filename, surface=self.surface, occupancy=self.occupancy, n_frames=self.n_frames,
+                            box=self.box if self.box is not None else np.zeros(3), sheet_xy=self.sheet_xy,
+                            classes=np.array(self.classes), settings=np.array([self.adsorption_height, self.max_height]))
+
+    @classmethod
+    def load(cls, filename):
+        data = np.load(filename)
+        adsorption_height, max_height = data['settings']
+        maps = cls(data['surface'].shape[1], data['occupancy'].shape[3], adsorption_height, max_height, list(data['classes']))
+        maps.surface, maps.occupancy = data['surface'], data['occupancy']
+        maps.n_frames, maps.box, maps.sheet_xy = int(data['n_frames']), data['box'], data['sheet_xy']
+        return maps
+
+def graph_density(maps, outfile):
+    """Heatmaps of the surface density of every class over the sheet lattice and their
+    height profiles, written to outfile."""
+    from rendering import pyplot, save_figure
+
+    plt = pyplot()
+    density = maps.surface_density()
+    profile = maps.height_profile()
+    extent = [0, maps.box[0], 0, maps.box[1]]
+    heights = (np.arange(maps.z_bins) + 0.5) * maps.max_height / maps.z_bins
+
+    fig, ax = plt.subplots(1, len(maps.classes) + 1, figsize=(5 * (len(maps.classes) + 1), 4))
+    for k, name in enumerate(maps.classes):
+        im = ax[k].imshow(density[k].T, origin='lower', extent=extent, cmap='viridis', vmin=0, vmax=density.max() or 1)
+        if len(maps.sheet_xy):
+            ax[k].scatter(maps.sheet_xy[:, 0] * maps.box[0], maps.sheet_xy[:, 1] * maps.box[1], s=2, c='w', alpha=0.5)
+        ax[k].set_xlabel('x (nm)')
+        ax[k].set_ylabel('y (nm)')
+        ax[k].set_title(f'{name} within {maps.adsorption_height} nm of the sheet')
+        fig.colorbar(im, ax=ax[k], label='sugars / nm$^2$')
+
+        ax[-1].plot(heights, profile[k], linewidth=1, label=name)
+    ax[-1].set_xlabel('Height above sheet (nm)')
+    ax[-1].set_ylabel('sugars / nm')
+    ax[-1].legend()
+
+    plt.tight_layout()
+    save_figure(fig, outfile)
@@ -0,0 +1,164 @@
+"""Sugar interaction energies of saved sheet trajectories.
+
+The system of a sheet simulation is rebuilt from its topology with the nonbonded
+interactions of every sugar class split by partner (sheet, other sugars, solvent and
+everything else, e.g. DGL/LGL or ions), each in its own force group. Saved frames are then re-evaluated on one reused Context, so
+D- and L-ribose binding energetics can be compared without rerunning anything.
+"""
+import json
+import time
+from contextlib import closing
+
+import numpy as np
+import mdtraj as md
+from openmm import Context, CustomNonbondedForce, NonbondedForce, System, Vec3, VerletIntegrator
+from openmm.app import ForceField, HBonds, NoCutoff, PDBFile
+from openmm.unit import elementary_charge, kilojoule_per_mole, nanometer
+
+from constants import ONE_4PI_EPS0
+from platforms import platform_from_config
+from topology_registry import SHEET, SUGARS, TopologyRegistry, groups_from_config
+from trajstore import count_frames, read_chunks
+
+# 'other' is every atom not in a sugar, the sheet or water, so the terms of a class add up
+# to its whole nonbonded interaction
+PARTNERS = ('sheet', 'sugar', 'solvent', 'other')
+PAIR_ENERGY = (f'{ONE_4PI_EPS0}*q1*q2/r + 4*epsilon*((sigma/r)^12 - (sigma/r)^6);'
+               'sigma = 0.5*(sigma1 + sigma2); epsilon = sqrt(epsilon1*epsilon2)')
+
+def interaction_force(nonbonded, group1, group2, exclusions):
+    """Lennard-Jones plus Coulomb between two atom sets with the parameters and exclusions
+    of nonbonded, exactly the NonbondedForce energy of those pairs. Only NoCutoff systems
+    are supported, like the ones ribose_sheet builds, since the pair terms cannot
+    reproduce PME or reaction field."""
+    if nonbonded.getNonbondedMethod() != NonbondedForce.NoCutoff:
+        raise ValueError('energy decomposition needs a NoCutoff NonbondedForce')
+
+    force = CustomNonbondedForce(PAIR_ENERGY)
+    for name in ('q', 'sigma', 'epsilon'):
+        force.addPerParticleParameter(name)
+    force.setNonbondedMethod(CustomNonbondedForce.NoCutoff)
+
+    for i in range(nonbonded.getNumParticles()):
+        charge, sigma, epsilon = nonbonded.getParticleParameters(i)
+        force.addParticle([charge.value_in_unit(elementary_charge), sigma.value_in_unit(nanometer), epsilon.value_in_unit(kilojoule_per_mole)])
+    for p1, p2 in exclusions:
+        force.addExclusion(p1, p2)
+
+    force.addInteractionGroup(group1, group2)
+    return force
+
+def decomposition_system(system, topology, groups):
+    """A system holding only the split sugar interactions, one force group per term.
+    Params
+    ======
+    system   (openmm.System) - full system, only its NonbondedForce is used
+    topology (md.Topology)
+    groups   (dict) - residue name groups, see topology_registry
+
+    Returns
+    =======
+    decomposition (openmm.System), terms (list) - '<class>-<partner>' name of every force group"""
+    registry = TopologyRegistry(topology, groups)
+    nonbonded = next(force for force in system.getForces() if isinstance(force, NonbondedForce))
+    exceptions = {tuple(sorted(int(p) for p in nonbonded.getExceptionParameters(i)[:2])) for i in range(nonbonded.getNumExceptions())}
+
+    sugars = registry.atoms(*SUGARS)
+    # sugar-sugar terms are intermolecular, every pair within one residue is excluded
+    intramolecular = {(int(a), int(b)) for atoms in (registry.residue_atoms(name) for name in SUGARS)
+                      for residue in atoms for i, a in enumerate(residue) for b in residue[i+1:]}
+    sheet = registry.atoms(*SHEET)
+    solvent = np.array([atom.index for atom in topology.atoms if atom.residue.is_water], dtype=int)
+    partners = {
+        'sheet': (sheet, exceptions),
+        'sugar': (sugars, exceptions | intramolecular),
+        'solvent': (solvent, exceptions),
+        'other': (np.setdiff1d(np.arange(topology.n_atoms), np.concatenate([sugars, sheet, solvent])), exceptions),
+    }
+
+    decomposition = System()
+    for i in range(system.getNumParticles()):
+        decomposition.addParticle(system.getParticleMass(i))
+    box = system.getDefaultPeriodicBoxVectors()
+    decomposition.setDefaultPeriodicBoxVectors(*box)
+
+    terms = []
+    for name in SUGARS:
+        atoms = registry.atoms(name)
+        for partner in PARTNERS:
+            partner_atoms, exclusions = partners[partner]
+            if not len(atoms) or not len(partner_atoms):
+                continue
+            force = interaction_force(nonbonded, [int(i) for i in atoms], [int(i) for i in partner_atoms], sorted(exclusions))
+            force.setForceGroup(len(terms))
+            decomposition.addForce(force)
+            terms.append(f'{name}-{partner}')
+    return decomposition, terms
+
+def build_system(top, sheet_config):
+    """Parameterizes the saved topology the way ribose_sheet.build_simulation does."""
+    from openmmforcefields.generators import GAFFTemplateGenerator
+    from ribose_sheet import load_test_mols
+
+    test_mol_names = sheet_config.get('Sheet Setup','test molecules').split(',')
+    test_resnames = sheet_config.get('Sheet Setup','test resnames').split(',')
+    mols = load_test_mols(test_mol_names, test_resnames)
+
+    forcefield = ForceField('amber14-all.xml', 'tip3p.xml')
+    forcefield.registerTemplateGenerator(GAFFTemplateGenerator(molecules=[mol['mol'] for mol in mols.values()]).generator)
+
+    pdb = PDBFile(top)
+    return forcefield.createSystem(pdb.topology, nonbondedMethod=NoCutoff, nonbondedCutoff=0.5*nanometer, constraints=HBonds)
+
+def decompose(dcd, top, outfile, config, sheet_config, device_idx=0, memory_budget_mb=512):
+    """Writes the energy of every term in every frame of dcd to outfile (.npy, float32,
+    n_frames x n_terms, kJ/mol) and the term names to <outfile>.json.
+
+    Returns
+    =======
+    terms (list), frames per second (float)"""
+    topology = md.load_topology(top)
+    system, terms = decomposition_system(build_system(top, sheet_config), topology, groups_from_config(config))
+
+    platform, properties, _ = platform_from_config(config, 'Energy Decomposition', device_idx)
+    context = Context(system, VerletIntegrator(0.001), platform, properties)
+    periodic = system.usesPeriodicBoundaryConditions()
+
+    n_frames = count_frames(dcd)
+    energies = np.lib.format.open_memmap(outfile, mode='w+', dtype=np.float32, shape=(n_frames, len(terms)))
+    with open(f'{outfile}.json', 'w') as f:
+        json.dump({'terms': terms, 'units': 'kJ/mol', 'dcd': dcd}, f)
+
+    start = time.perf_counter()
+    frame = 0
+    # full system coordinates, water included, so the compact store is not used here
+    with closing(read_chunks(dcd, top, False, memory_budget_mb)) as chunks:
+        for chunk in chunks:
+            for xyz, box in zip(chunk.xyz, chunk.unitcell_vectors if periodic else [None] * chunk.n_frames):
+                if frame == n_frames:
+                    break
+                if box is not None:
+                    context.setPeriodicBoxVectors(*(Vec3(*vector) for vector in box))
+                context.setPositions(xyz)
+                for group in range(len(terms)):
+                    energies[frame, group] = context.getState(getEnergy=True, groups={group}).getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+                frame += 1
+
+    energies.flush()
+    return terms, frame / (time.perf_counter() - start)
+
+def main(config_file='analysis_config.ini'):
+    from ribose_analysis import find_sims, get_config
+
+    config = get_config(config_file)
+    outdir = config.get('Output Parameters','output directory')
+    memory_budget = float(config.get('Input Setup','memory budget mb', fallback=512))
+    sheet_config = get_config(config.get('Energy Decomposition','sheet config', fallback='sheet_config.ini'))
+
+    # numbered like the sims of ribose_analysis
+    for sim_number, (dcd, top, _) in enumerate(find_sims(config)):
+        terms, rate = decompose(dcd, top, f'{outdir}/energies_{sim_number}.npy', config, sheet_config, memory_budget_mb=memory_budget)
+        print(f"Sim {sim_number}: {', '.join(terms)} at {rate:.0f} frames/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,75 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+CACHE_DIR = '.mol_cache'
+
+def cache_key(filename, resname, charge_method):
+    """Hash of the sdf contents, the residue name, the charge method and the toolkit version,
+    so editing a molecule or upgrading openff invalidates the entry."""
+    from openff.toolkit import __version__ as toolkit_version
+
+    key = hashlib.sha256()
+    with open(filename, 'rb') as f:
+        key.update(f.read())
+    key.update(f'{resname}:{charge_method}:{toolkit_version}'.encode())
+    return key.hexdigest()[:16]
+
+def prepare_molecule(filename, charge_method='am1bcc'):
+    """Parses an sdf, generates conformers and assigns partial charges (the slow part).
+    charge_method None skips the charges, for molecules that are never parameterized."""
+    from openff.toolkit.topology import Molecule
+
+    mol = Molecule.from_file(filename, file_format='sdf')
+    mol.generate_conformers()
+    if charge_method is not None:
+        mol.assign_partial_charges(charge_method)
+    return mol
+
+def write_cache(cache_file, mol):
+    # the json carries the conformers and partial charges, so a hit never reruns the charge method
+    # write to a temporary file first so workers starting at the same time never read a partial entry
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(cache_file), suffix='.npz')
+    with os.fdopen(fd, 'wb') as f:
+        np.savez(f, molecule=np.array(mol.to_json()))
+    os.replace(tmp, cache_file)
+
+def load_molecule(filename, resname, cache_dir=CACHE_DIR, charge_method='am1bcc'):
+    """Loads a prepared molecule, preparing and caching it on the first call.
+    Params
+    ======
+    filename      (str) - sdf file
+    resname       (str) - residue name given to the molecule in the openmm topology
+    cache_dir     (str) - directory holding the cached .npz entries
+    charge_method (str) - partial charge method, cached charges are reused by GAFFTemplateGenerator.
+                          None leaves the molecule uncharged
+
+    Returns
+    =======
+    dict with the openff molecule, renamed openmm topology, conformer positions and resname"""
+    # openff is slow to import, so only pay for it when a molecule is actually loaded
+    from openff.toolkit.topology import Molecule
+    from openff.units.openmm import to_openmm
+
+    os.makedirs(cache_dir, exist_ok=True)
+    stem = os.path.splitext(os.path.basename(filename))[0]
+    cache_file = os.path.join(cache_dir, f'{stem}_{cache_key(filename, resname, charge_method)}.npz')
+
+    if not os.path.exists(cache_file):
+        write_cache(cache_file, prepare_molecule(filename, charge_method))
+
+    with np.load(cache_file) as entry:
+        mol = Molecule.from_json(str(entry['molecule']))
+
+    conf = to_openmm(mol.conformers[0])
+    top = mol.to_topology().to_openmm()
+    next(top.residues()).name = resname
+
+    return {
+        "mol": mol,
+        "topology": top,
+        "positions": conf,
+        'resname': resname
+    }
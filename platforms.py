@@ -0,0 +1,82 @@
+import json
+import os
+
+from openmm import Platform
+
+# order in which platforms are tried when the config asks for 'auto'
+PLATFORM_ORDER = ['CUDA', 'OpenCL', 'CPU', 'Reference']
+
+def available_platforms():
+    return [Platform.getPlatform(i).getName() for i in range(Platform.getNumPlatforms())]
+
+def get_platform_config(config, section):
+    """Reads the platform options from a config section.
+    Params
+    ======
+    config  (configparser.ConfigParser)
+    section (str) - section holding the 'platform', 'precision' and 'threads' keys
+
+    Returns
+    =======
+    name, precision, threads (str, str, int or None)"""
+    name = config.get(section, 'platform', fallback='auto')
+    precision = config.get(section, 'precision', fallback='single')
+    threads = config.get(section, 'threads', fallback='')
+    threads = int(threads) if threads.strip() else None
+    return name, precision, threads
+
+def select_platform(name='auto', device_idx=0, precision='single', threads=None):
+    """Picks an OpenMM platform and builds the matching property dict.
+    Params
+    ======
+    name       (str) - CUDA, OpenCL, CPU, Reference or auto (fastest available)
+    device_idx (int) - gpu index, ignored on CPU and Reference
+    precision  (str) - single, mixed or double, ignored on CPU and Reference
+    threads    (int) - number of CPU threads, None lets OpenMM decide
+
+    Returns
+    =======
+    platform (openmm.Platform), properties (dict), precision (str)"""
+    available = available_platforms()
+
+    if name.lower() == 'auto':
+        name = next(p for p in PLATFORM_ORDER if p in available)
+    elif name not in available:
+        raise ValueError(f"Platform {name} is not available, found {', '.join(available)}")
+
+    platform = Platform.getPlatformByName(name)
+    properties = {}
+
+    if name == 'CUDA':
+        properties = {'CudaDeviceIndex': str(device_idx), 'CudaPrecision': precision}
+    elif name == 'OpenCL':
+        properties = {'OpenCLDeviceIndex': str(device_idx), 'OpenCLPrecision': precision}
+    elif name == 'CPU':
+        # the CPU platform always runs in mixed precision
+        precision = 'mixed'
+        if threads is not None:
+            properties = {'Threads': str(threads)}
+    else:
+        precision = 'double'
+
+    return platform, properties, precision
+
+def platform_from_config(config, section, device_idx):
+    name, precision, threads = get_platform_config(config, section)
+    return select_platform(name, device_idx, precision, threads)
+
+def platform_metadata(context, precision):
+    """Collects the platform actually used by a context."""
+    platform = context.getPlatform()
+    properties = {prop: platform.getPropertyValue(context, prop) for prop in platform.getPropertyNames()}
+    return {
+        'platform': platform.getName(),
+        'precision': precision,
+        'properties': properties,
+        'openmm version': Platform.getOpenMMVersion(),
+    }
+
+def write_metadata(filename, metadata):
+    os.makedirs(os.path.dirname(filename) or '.', exist_ok=True)
+    with open(filename, 'w') as metadata_file:
+        json.dump(metadata, metadata_file, indent=2)
@@ -0,0 +1,140 @@
+import cProfile
+import json
+import os
+import resource
+import time
+from contextlib import contextmanager
+
+def peak_rss_mb():
+    """High-water mark of the whole process so far."""
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def reset_peak_rss():
+    """Resets the kernel's RSS high-water mark (VmHWM), linux only.
+
+    Returns
+    =======
+    reset (bool) - False where the peak cannot be reset"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+def current_peak_rss_mb():
+    """VmHWM, the peak RSS since the last reset_peak_rss()."""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1024
+    return peak_rss_mb()
+
+class PhaseTimer:
+    """Records wall time, CPU time and peak RSS of the named phases of one job.
+
+    On linux the RSS high-water mark is reset when a phase starts, so 'peak rss MB' is
+    the peak reached inside that phase (the largest over its calls, nested phases count
+    toward their parents). Elsewhere only the process-wide peak is available and it is
+    recorded as 'process peak rss MB' instead.
+
+    Phases entered more than once (e.g. every chunk of a trajectory) are summed, and
+    flush() appends one JSON line per phase to the timings file. Phases listed in
+    `profile` are also run under cProfile and dumped as .prof files (pstats format,
+    readable by snakeviz or `python -m pstats`). Used as a context manager it flushes on
+    exit, whether or not the job raised.
+    """
+    def __init__(self, filename=None, jobid=None, profile=(), profile_dir='.'):
+        self.filename = filename
+        self.jobid = jobid
+        self.profile = set(profile)
+        self.profile_dir = profile_dir
+        self.phases = {}
+        self.profilers = {}
+        # running peak of every open phase, a nested phase's reset must not lose its parent's peak
+        self.open_peaks = []
+        self.per_phase_peak = reset_peak_rss()
+
+    def _update_open_peaks(self):
+        if self.open_peaks:
+            peak = current_peak_rss_mb()
+            self.open_peaks = [max(open_peak, peak) for open_peak in self.open_peaks]
+
+    @contextmanager
+    def phase(self, name):
+        profiler = self.profilers.setdefault(name, cProfile.Profile()) if name in self.profile else None
+        if self.per_phase_peak:
+            self._update_open_peaks()
+            reset_peak_rss()
+            self.open_peaks.append(0.0)
+        wall, cpu = time.perf_counter(), time.process_time()
+        if profiler:
+            profiler.enable()
+        try:
+            yield
+        finally:
+            if profiler:
+                profiler.disable()
+
+            record = self.phases.setdefault(name, {'calls': 0, 'wall s': 0.0, 'cpu s': 0.0})
+            record['calls'] += 1
+            record['wall s'] += time.perf_counter() - wall
+            record['cpu s'] += time.process_time() - cpu
+            if self.per_phase_peak:
+                self._update_open_peaks()
+                record['peak rss MB'] = max(record.get('peak rss MB', 0.0), self.open_peaks.pop())
+            else:
+                record['process peak rss MB'] = peak_rss_mb()
+
+    def iterate(self, iterable, name):
+        """Yields from iterable, recording the time spent producing each item (e.g. reading trajectory chunks)."""
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                item = next(iterator, StopIteration)
+            if item is StopIteration:
+                return
+            yield item
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        # runs on failures too, the timings of a job that crashed are the ones worth reading
+        self.flush()
+        return False
+
+    def flush(self):
+        """Appends the recorded phases to the timings file, dumps the profiles and clears them."""
+        for name, profiler in self.profilers.items():
+            profiler.dump_stats(os.path.join(self.profile_dir, f'profile_{self.jobid}_{name}.prof'))
+        self.profilers = {}
+
+        if self.filename and self.phases:
+            with open(self.filename, 'a') as f:
+                for name, record in self.phases.items():
+                    f.write(json.dumps({'job': self.jobid, 'phase': name, **record, 'time': time.time()}) + '\n')
+        self.phases = {}
+
+class TimedReporter:
+    """Wraps an OpenMM reporter so the time spent writing its output is recorded as a phase."""
+    def __init__(self, reporter, timer, name):
+        self.reporter = reporter
+        self.timer = timer
+        self.name = name
+
+    def describeNextReport(self, simulation):
+        return self.reporter.describeNextReport(simulation)
+
+    def report(self, simulation, state):
+        with self.timer.phase(self.name):
+            self.reporter.report(simulation, state)
+
+def timer_from_config(config, section, jobid, outdir):
+    """Builds a PhaseTimer from the 'timing' and 'profile phases' keys of a config section.
+    With timing disabled phases are still measured but never written."""
+    timing = config.get(section, 'timing', fallback='False') == 'True'
+    profile = [name.strip() for name in config.get(section, 'profile phases', fallback='').split(',') if name.strip()]
+    filename = f'{outdir}/timings_{jobid}.jsonl' if timing else None
+    return PhaseTimer(filename, jobid, profile, outdir)
@@ -0,0 +1,150 @@
+"""Staged energy minimization for boxes of randomly placed molecules.
+
+Overlapping molecules make the full Lennard-Jones and Coulomb terms diverge, so a plain
+minimizeEnergy() either runs for a very long time or ends in NaN coordinates. relax()
+first removes the clashes on a copy of the system whose nonbonded interactions are
+capped, then minimizes with the full force field and finally warms the system up from
+a low temperature, checking the energy after every stage.
+"""
+import numpy as np
+from openmm import Context, CustomNonbondedForce, LocalEnergyMinimizer, NonbondedForce, VerletIntegrator, XmlSerializer
+from openmm.unit import elementary_charge, kelvin, kilojoule_per_mole, nanometer
+
+from constants import ONE_4PI_EPS0
+from profiling import PhaseTimer
+
+# capped Lennard-Jones and Coulomb, finite at r = 0 (4*epsilon*(1/alpha^2 - 1/alpha) for the LJ part)
+SOFT_CORE = (f'4*epsilon*(1/x^2 - 1/x) + {ONE_4PI_EPS0}*q/sqrt(r^2 + delta^2);'
+             'x = (r/sigma)^6 + alpha;'
+             'sigma = 0.5*(sigma1 + sigma2); epsilon = sqrt(epsilon1*epsilon2); q = q1*q2')
+
+def relax_config(config, section='Minimization'):
+    """Reads the minimization options, missing keys fall back to the defaults below."""
+    return {
+        'soft core': config.get(section, 'soft core', fallback='True') == 'True',
+        'alpha': float(config.get(section, 'soft core alpha', fallback=0.5)),
+        'delta': float(config.get(section, 'soft core delta', fallback=0.1)),
+        'soft iterations': int(config.get(section, 'soft core iterations', fallback=500)),
+        'tolerance': float(config.get(section, 'tolerance', fallback=10)),
+        'max iterations': int(config.get(section, 'max iterations', fallback=1000)),
+        'warm up steps': int(config.get(section, 'warm up steps', fallback=1000)),
+        'warm up temperature': float(config.get(section, 'warm up temperature', fallback=50)),
+    }
+
+def soft_core_system(system, alpha=0.5, delta=0.1):
+    """Copy of system with the NonbondedForce particle terms replaced by SOFT_CORE.
+    Exceptions (bonded pairs and scaled 1-4 terms) stay in the NonbondedForce and are
+    excluded from the soft-core force."""
+    soft = XmlSerializer.deserialize(XmlSerializer.serialize(system))
+    nonbonded = next(force for force in soft.getForces() if isinstance(force, NonbondedForce))
+
+    custom = CustomNonbondedForce(SOFT_CORE)
+    custom.addGlobalParameter('alpha', alpha)
+    custom.addGlobalParameter('delta', delta)
+    for name in ('q', 'sigma', 'epsilon'):
+        custom.addPerParticleParameter(name)
+
+    if nonbonded.getNonbondedMethod() == NonbondedForce.NoCutoff:
+        custom.setNonbondedMethod(CustomNonbondedForce.NoCutoff)
+    else:
+        custom.setNonbondedMethod(CustomNonbondedForce.CutoffPeriodic)
+        custom.setCutoffDistance(nonbonded.getCutoffDistance())
+
+    for i in range(nonbonded.getNumParticles()):
+        charge, sigma, epsilon = nonbonded.getParticleParameters(i)
+        custom.addParticle([charge.value_in_unit(elementary_charge), sigma.value_in_unit(nanometer), epsilon.value_in_unit(kilojoule_per_mole)])
+        nonbonded.setParticleParameters(i, 0, sigma, 0)
+
+    for i in range(nonbonded.getNumExceptions()):
+        p1, p2, _, _, _ = nonbonded.getExceptionParameters(i)
+        custom.addExclusion(p1, p2)
+
+    soft.addForce(custom)
+    return soft
+
+def potential_energy(context):
+    return context.getState(getEnergy=True).getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+
+def check_energy(energy, stage):
+    if not np.isfinite(energy):
+        raise ValueError(f'Potential energy is {energy} after {stage}')
+
+def relax(simulation, config, timer=None, section='Minimization', properties=None):
+    """Minimizes and warms up a simulation whose positions are already set.
+    Params
+    ======
+    simulation (openmm.app.Simulation)
+    config     (configparser.ConfigParser)
+    timer      (profiling.PhaseTimer) - optional, records every stage as a phase
+    section    (str) - config section holding the minimization options
+    properties (dict) - platform properties the simulation was created with, see
+                        platforms.select_platform. Without them only the device index and
+                        precision are copied from the context
+
+    Returns
+    =======
+    energies (dict) - full force field potential energy (kJ/mol) after every stage"""
+    options = relax_config(config, section)
+    timer = timer or PhaseTimer()
+    context = simulation.context
+    energies = {'initial': potential_energy(context)}
+
+    if options['soft core']:
+        with timer.phase('softCoreMinimize'):
+            # a separate context on the same device, with the same platform properties
+            platform = context.getPlatform()
+            if properties is None:
+                # the context also reports read-only properties (DeviceName, ...) that a new Context rejects
+                properties = {name: platform.getPropertyValue(context, name) for name in platform.getPropertyNames()
+                              if name.endswith(('DeviceIndex', 'Precision'))}
+            soft = Context(soft_core_system(simulation.system, options['alpha'], options['delta']), VerletIntegrator(0.001), platform, properties)
+
+            state = context.getState(getPositions=True)
+            soft.setPeriodicBoxVectors(*state.getPeriodicBoxVectors())
+            soft.setPositions(state.getPositions())
+            # restraint and bias parameters the caller may have changed on the context
+            for name in context.getParameters():
+                soft.setParameter(name, context.getParameter(name))
+            LocalEnergyMinimizer.minimize(soft, options['tolerance'], options['soft iterations'])
+
+            context.setPositions(soft.getState(getPositions=True).getPositions())
+            del soft
+        energies['soft core'] = potential_energy(context)
+        check_energy(energies['soft core'], 'soft-core minimization')
+
+    with timer.phase('minimizeEnergy'):
+        simulation.minimizeEnergy(tolerance=options['tolerance']*kilojoule_per_mole/nanometer, maxIterations=options['max iterations'])
+    energies['minimized'] = potential_energy(context)
+    check_energy(energies['minimized'], 'minimization')
+
+    integrator = simulation.integrator
+    if options['warm up steps'] > 0 and hasattr(integrator, 'setTemperature'):
+        with timer.phase('warmUp'):
+            temperature = integrator.getTemperature()
+            # heat from the warm-up temperature to the run temperature in a few increments
+            ramp = np.linspace(options['warm up temperature'], temperature.value_in_unit(kelvin), 5)
+            context.setVelocitiesToTemperature(ramp[0]*kelvin)
+            for step_temperature in ramp:
+                integrator.setTemperature(step_temperature*kelvin)
+                simulation.step(options['warm up steps'] // len(ramp))
+            integrator.setTemperature(temperature)
+            # the warm-up is not part of the run, reporters and trajectory times start from zero
+            simulation.currentStep = 0
+            context.setTime(0)
+        energies['warm up'] = potential_energy(context)
+        check_energy(energies['warm up'], 'warm-up')
+
+    return energies
+
+def relax_and_report(simulation, config, jobid, timer=None, properties=None):
+    """relax() with the options of the [Minimization] section, printing the energy after
+    every stage when the output is verbose.
+
+    Returns
+    =======
+    energies (dict) - see relax"""
+    #soft-core, full force field and warm-up stages, each recorded as a timer phase
+    energies = relax(simulation, config, timer, properties=properties)
+    if(config.get('Output Parameters','verbose', fallback='False')=='True'):
+        print("Relaxed:", jobid, ', '.join(f'{stage} {energy:.1f} kJ/mol' for stage, energy in energies.items()))
+    return energies
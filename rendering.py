@@ -0,0 +1,133 @@
+"""Headless figure rendering.
+
+Figures are drawn with the Agg backend and saved to files, never shown, so analyses run
+unattended on compute nodes. Long time series are decimated and KDEs are evaluated on a
+binned grid before plotting, since a figure a couple of thousand pixels wide cannot show
+more points than that, and render_all draws independent figures in a process pool.
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+# points kept per series, a few per horizontal pixel of a typical figure
+MAX_POINTS = 2000
+
+def pyplot():
+    """matplotlib.pyplot on the non-interactive Agg backend."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    return plt
+
+def save_figure(fig, outfile, dpi=150):
+    fig.savefig(outfile, dpi=dpi, bbox_inches='tight')
+    pyplot().close(fig)
+
+def minmax(x, y, n_out=MAX_POINTS):
+    """Keeps the minimum and maximum of y in each of n_out/2 buckets, in time order, so
+    spikes survive the decimation. NaNs are dropped."""
+    x, y = np.asarray(x), np.asarray(y)
+    keep = np.isfinite(y)
+    x, y = x[keep], y[keep]
+    n_buckets = n_out // 2
+    if len(y) <= n_out:
+        return x, y
+
+    edges = np.linspace(0, len(y), n_buckets + 1).astype(int)
+    bucket = np.repeat(np.arange(n_buckets), np.diff(edges))
+    # position of the min and max inside every bucket, via a stable sort on (bucket, y)
+    order = np.lexsort((y, bucket))
+    first, last = order[edges[:-1]], order[edges[1:] - 1]
+    index = np.sort(np.concatenate([first, last]))
+    return x[index], y[index]
+
+def lttb(x, y, n_out=MAX_POINTS):
+    """Largest-Triangle-Three-Buckets decimation: from every bucket keeps the point that
+    spans the largest triangle with the previously kept point and the mean of the next
+    bucket, which preserves the visual shape of the series."""
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    keep = np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if len(y) <= n_out or n_out < 3:
+        return x, y
+
+    edges = np.linspace(1, len(y) - 1, n_out - 1).astype(int)
+    index = np.empty(n_out, dtype=int)
+    index[0], index[-1] = 0, len(y) - 1
+    for k in range(n_out - 2):
+        start, stop = edges[k], edges[k + 1]
+        following = slice(stop, edges[k + 2]) if k + 2 < len(edges) else slice(len(y) - 1, len(y))
+        mean_x, mean_y = x[following].mean(), y[following].mean()
+        previous = index[k]
+        area = np.abs((x[previous] - mean_x) * (y[start:stop] - y[previous]) - (x[previous] - x[start:stop]) * (mean_y - y[previous]))
+        index[k + 1] = start + np.argmax(area)
+    return x[index], y[index]
+
+def binned_kde(data, n_grid=512, bandwidth=None):
+    """Gaussian KDE evaluated by binning the data on a grid and convolving with the kernel,
+    O(n + n_grid log n_grid) instead of O(n * n_grid). Bandwidth defaults to Scott's rule.
+
+    Returns
+    =======
+    grid, density (np.ndarray)"""
+    data = np.asarray(data, dtype=float).ravel()
+    data = data[np.isfinite(data)]
+    if len(data) < 2 or np.ptp(data) == 0:
+        return np.array([]), np.array([])
+
+    bandwidth = bandwidth or 1.06 * np.std(data) * len(data) ** (-1 / 5)
+    low, high = data.min() - 3 * bandwidth, data.max() + 3 * bandwidth
+    counts, edges = np.histogram(data, bins=n_grid, range=(low, high))
+    grid = 0.5 * (edges[1:] + edges[:-1])
+    step = grid[1] - grid[0]
+
+    offsets = np.arange(-n_grid + 1, n_grid) * step
+    kernel = np.exp(-0.5 * (offsets / bandwidth) ** 2)
+    size = 2 ** int(np.ceil(np.log2(len(counts) + len(kernel))))
+    density = np.fft.irfft(np.fft.rfft(counts, size) * np.fft.rfft(kernel, size), size)[n_grid - 1:2 * n_grid - 1]
+    density = np.clip(density, 0, None)
+    return grid, density / (density.sum() * step)
+
+def plot_series(ax, x, y, n_out=MAX_POINTS, downsample=lttb, **kwargs):
+    """ax.plot of a series decimated with downsample (lttb, or minmax where single frame
+    spikes have to stay visible)."""
+    return ax.plot(*downsample(x, y, n_out), **kwargs)
+
+def plot_kde(ax, data, **kwargs):
+    return ax.plot(*binned_kde(data), **kwargs)
+
+def _render(function, args, outfile):
+    pyplot()
+    function(*args, outfile=outfile)
+    return outfile
+
+def render_all(tasks, workers=None):
+    """Renders (function, args, outfile) tasks concurrently, function(*args, outfile=outfile)
+    must save its figure. Functions and arguments must be picklable (module level
+    functions, arrays, ResultsStore). workers=1 renders in this process. Every task is
+    attempted either way, and failures are raised together once all of them are done.
+
+    Returns
+    =======
+    outfiles (list) - files that were written"""
+    workers = workers or min(len(tasks), os.cpu_count() or 1)
+    written, failed = [], {}
+    if workers <= 1:
+        for task in tasks:
+            try:
+                written.append(_render(*task))
+            except Exception as e:
+                failed[task[2]] = e
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            futures = [(task[2], pool.submit(_render, *task)) for task in tasks]
+            for outfile, future in futures:
+                try:
+                    written.append(future.result())
+                except Exception as e:
+                    failed[outfile] = e
+
+    if failed:
+        raise RuntimeError(f'{len(failed)} of {len(tasks)} figures failed: ' + '; '.join(f'{outfile}: {e!r}' for outfile, e in failed.items()))
+    return written
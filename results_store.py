@@ -0,0 +1,166 @@
+"""Per-frame analysis results in one long HDF5 table (pandas/PyTables).
+
+Every row of the 'frames' table is one value: sim, frame, time, metric, group, value.
+Metrics with several values per frame (per-residue SASA) repeat the frame. The 'counts'
+table holds the number of molecules of every residue class in every sim, so counts can
+be normalized per molecule of the sim they came from.
+"""
+import os
+
+import numpy as np
+
+COLUMNS = ['sim', 'frame', 'time', 'metric', 'group', 'value']
+# the string columns of a table are sized when it is created
+MIN_ITEMSIZE = {'metric': 32, 'group': 32}
+
+class Series:
+    """Preallocated frame, time and value arrays of one metric and group, grown by doubling."""
+    def __init__(self, capacity):
+        self.n = 0
+        self.frame = np.empty(capacity, dtype=np.int64)
+        self.time = np.empty(capacity)
+        self.value = np.empty(capacity)
+
+    def extend(self, frame, time, value):
+        n = len(value)
+        if self.n + n > len(self.value):
+            capacity = max(2 * len(self.value), self.n + n)
+            for name in ('frame', 'time', 'value'):
+                grown = np.empty(capacity, dtype=getattr(self, name).dtype)
+                grown[:self.n] = getattr(self, name)[:self.n]
+                setattr(self, name, grown)
+
+        self.frame[self.n:self.n+n] = frame
+        self.time[self.n:self.n+n] = time
+        self.value[self.n:self.n+n] = value
+        self.n += n
+
+class FrameResults:
+    """Per-frame results of one sim, accumulated chunk by chunk.
+    Params
+    ======
+    sim      (int) - sim id
+    n_frames (int) - expected number of frames, the arrays are allocated for it up front
+    """
+    def __init__(self, sim, n_frames=1024):
+        self.sim = sim
+        self.capacity = max(n_frames, 1)
+        self.series = {}
+        self.counts = {}
+
+    def add(self, metric, group, start, time, values):
+        """Adds the values of one chunk.
+        Params
+        ======
+        start  (int or np.ndarray) - frame index of the first frame of the chunk, or the
+                                     frame index of every row for subsampled metrics
+        time   (np.ndarray) - time of every row
+        values (np.ndarray) - (n_frames,) or (n_frames, k), None is skipped"""
+        if values is None:
+            return
+        values = np.asarray(values, dtype=float)
+        values = values.reshape(len(values), -1)
+        per_frame = values.shape[1]
+        frames = np.asarray(start) if np.ndim(start) else np.arange(start, start + len(values))
+
+        if (metric, group) not in self.series:
+            self.series[metric, group] = Series(self.capacity * per_frame)
+        self.series[metric, group].extend(np.repeat(frames, per_frame), np.repeat(time, per_frame), values.ravel())
+
+    def set_counts(self, registry):
+        """Molecules of every residue class, from a topology_registry.TopologyRegistry."""
+        self.counts = {name: len(registry.residues(name)) for name in registry.class_names}
+
+    def to_frame(self):
+        import pandas as pd
+
+        frames = [pd.DataFrame({'sim': self.sim, 'frame': series.frame[:series.n], 'time': series.time[:series.n],
+                                'metric': metric, 'group': group, 'value': series.value[:series.n]})
+                  for (metric, group), series in self.series.items() if series.n]
+        return pd.concat(frames, ignore_index=True)[COLUMNS] if frames else None
+
+class ResultsStore:
+    """Query and write access to the results file."""
+    def __init__(self, filename):
+        self.filename = filename
+
+    def clear(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+    def write(self, results):
+        """Appends one FrameResults, replacing any earlier rows of the same sim."""
+        import pandas as pd
+
+        frames = results.to_frame()
+        counts = pd.DataFrame({'sim': results.sim, 'group': list(results.counts), 'count': list(results.counts.values())})
+        with pd.HDFStore(self.filename, mode='a', complevel=5, complib='blosc') as store:
+            for key, table, data_columns in (('frames', frames, ['sim', 'frame', 'metric', 'group']), ('counts', counts, ['sim', 'group'])):
+                if f'/{key}' in store:
+                    store.remove(key, where=f'sim == {results.sim}')
+                if table is not None and len(table):
+                    store.append(key, table, format='table', data_columns=data_columns,
+                                 min_itemsize={column: MIN_ITEMSIZE[column] for column in data_columns if column in MIN_ITEMSIZE}, index=False)
+
+    def write_sims(self, sims):
+        """Table describing every sim id (run, replicate and sweep parameters), one dict per sim."""
+        import pandas as pd
+
+        if sims:
+            pd.DataFrame(sims).astype({'run': str}).to_hdf(self.filename, key='sims', mode='a')
+
+    def sims(self):
+        import pandas as pd
+
+        return pd.read_hdf(self.filename, 'sims').set_index('sim')
+
+    def select(self, metric, groups=None, sims=None, columns=('sim', 'frame', 'group', 'value')):
+        """Rows of one metric, optionally only some groups and sims. Only the rows of the
+        metric are read from disk and only the requested columns are kept."""
+        import pandas as pd
+
+        where = [f'metric == {metric!r}']
+        if groups is not None:
+            where.append(f'group in {list(groups)!r}')
+        if sims is not None:
+            where.append(f'sim in {list(sims)!r}')
+        with pd.HDFStore(self.filename, mode='r') as store:
+            if '/frames' not in store:
+                return pd.DataFrame(columns=list(columns))
+            return store.select('frames', where=' & '.join(where), columns=list(columns))
+
+    def values(self, metric, group):
+        """All values of one group of a metric over every sim and frame, e.g. for histograms."""
+        return self.select(metric, [group], columns=['value'])['value'].to_numpy()
+
+    def counts(self):
+        """(sim x class) table of molecule counts."""
+        import pandas as pd
+
+        return pd.read_hdf(self.filename, 'counts').pivot(index='sim', columns='group', values='count')
+
+    def aggregate(self, metric, groups, normalize=None, sims=None, index='frame'):
+        """Mean over sims of every frame. Sims are aligned on the frame index or on the
+        simulation time, so sims of different length only contribute to the frames they have.
+        Params
+        ======
+        groups    (list) - groups of the metric, one column each in the result
+        normalize (dict) - {group: [residue classes]}, values of the group are divided by the
+                           number of molecules of those classes in the sim they came from
+        index     (str) - 'frame' or 'time' (ps), what sims are aligned on. Use time when
+                          sims may have been written with different report intervals
+
+        Returns
+        =======
+        means (pd.DataFrame) - indexed by frame or time, NaN where no sim has the group"""
+        data = self.select(metric, groups, sims, columns=('sim', index, 'group', 'value'))
+
+        if normalize:
+            counts = self.counts().replace(0, np.nan)
+            for group, classes in normalize.items():
+                rows = data['group'] == group
+                per_sim = counts.reindex(columns=list(classes)).sum(axis=1, min_count=len(classes))
+                data.loc[rows, 'value'] = data.loc[rows, 'value'] / data.loc[rows, 'sim'].map(per_sim).to_numpy()
+
+        means = data.groupby([index, 'group'])['value'].mean().unstack('group')
+        return means.reindex(columns=list(groups))
@@ -1,117 +1,114 @@
 import numpy as np 
-import json 
-from openmm.unit import *
-import glob
-import matplotlib.pyplot as ax
-from tqdm import tqdm as pbar
-from mpl_toolkits.mplot3d import Axes3D
-from pylab import *
-import ripser
 import mdtraj as md
-import argparse
-from scipy.stats import gaussian_kde
-from scipy.fft import fft, ifft
-import seaborn as sns
 import configparser
-
-def get_config():
+from contextlib import closing
+from profiling import timer_from_config
+from trajstore import count_frames, read_chunks
+from topology_registry import SHEET, get_registry, groups_from_config
+from results_store import FrameResults, ResultsStore
+from sim_files import run_files
+from sweep import discover_runs
+from clustering import cluster_sugars, persistence
+from density import DensityMaps, graph_density
+from rendering import minmax, plot_kde, plot_series, pyplot, render_all, save_figure
+
+# groups of the 'hbonds' metric in the order compute_hbonds returns them, and the residue
+# classes whose molecule count each is normalized by
+HBOND_GROUPS = ['DRI-G', 'DRI-C', 'DRI-sheet', 'LRI-G', 'LRI-C', 'LRI-sheet', 'DRI-DRI', 'DRI-LRI', 'LRI-LRI']
+HBOND_NORMALIZE = {
+    'DRI-G': ['DRI'], 'DRI-C': ['DRI'], 'DRI-sheet': ['DRI'],
+    'LRI-G': ['LRI'], 'LRI-C': ['LRI'], 'LRI-sheet': ['LRI'],
+    'DRI-DRI': ['DRI'], 'DRI-LRI': ['DRI', 'LRI'], 'LRI-LRI': ['LRI'],
+}
+
+def get_config(filename='analysis_config.ini'):
     config = configparser.ConfigParser()
-    config.read('analysis_config.ini')
+    config.read(filename)
     return config
 
-def compute_heights(traj):
-    sheet_atoms = traj.topology.select('resn "G" or resn "C"')
-    try:
-        dribose_atoms = traj.topology.select('resn "DRI"')
-        if len(dribose_atoms) > 0:
-            dribose_heights = md.compute_distances(traj, np.array([[sheet_atom, dribose_atom] for sheet_atom in sheet_atoms for dribose_atom in dribose_atoms]))[:, 0]
-        else:
-            print('No D-ribose in this sim')
-            dribose_heights = None
-    except:
-        print('No D-ribose in this sim')
-        dribose_heights = None
-    
-    try:
-        lribose_atoms = traj.topology.select('resn "LRI"')
-        if len(lribose_atoms) > 0:
-            lribose_heights = md.compute_distances(traj, np.array([[sheet_atom, lribose_atom] for sheet_atom in sheet_atoms for lribose_atom in lribose_atoms]))[:, 0]
+def find_sims(config):
+    """Trajectories to analyze as (dcd, topology, description). When the input directory
+    holds a sweep (sweep.py) every finished replicate of every run is used, otherwise the
+    'number sims' replicates of a single ribose_sheet run with the configured lconc and steps."""
+    indir = config.get('Input Setup','input directory')
+    runs = discover_runs(indir)
+    if runs:
+        return [(dcd, top, {'run': run['run'], 'replicate': replicate, **run['params']})
+                for run in runs for replicate, dcd, top in run['sims']]
+
+    sims = int(config.get('Input Setup','number sims'))
+    sim_length = int(config.get('Input Setup','number steps'))
+    lconc = int(config.get('Input Setup','lconc'))
+    return [(*run_files(indir, sim_number, lconc, sim_length), {'run': '', 'replicate': sim_number}) for sim_number in range(sims)]
+
+def compute_heights(traj, registry=None):
+    registry = registry or get_registry(traj.topology)
+    sheet_atoms = registry.atoms(*SHEET)
+    if len(sheet_atoms) == 0:
+        raise ValueError(f"No sheet residues ({', '.join('/'.join(registry.groups[name]) for name in SHEET)}) in this topology")
+
+    heights = []
+    for name, label in (('DRI', 'D-ribose'), ('LRI', 'L-ribose')):
+        sugar_atoms = registry.atoms(name)
+        if len(sugar_atoms) > 0:
+            # the height is read off the first sheet atom - first sugar atom pair
+            heights.append(md.compute_distances(traj, np.array([[sheet_atoms[0], sugar_atoms[0]]]))[:, 0])
         else:
-            print('No L-ribose in this sim')
-            lribose_heights = None
-    except:
-        print('No L-ribose in this sim')
-        lribose_heights = None
-    
-    return dribose_heights, lribose_heights
+            print(f'No {label} in this sim')
+            heights.append(None)
+
+    return tuple(heights)
+
+def graph_heights(store, outfile='heights.png'):
+    plt = pyplot()
 
-def graph_heights(dribose_heights, lribose_heights):
-    dribose_heights = np.array(dribose_heights)
-    lribose_heights = np.array(lribose_heights)
+    dribose_heights = store.values('height', 'DRI')
+    lribose_heights = store.values('height', 'LRI')
 
     fig, ax = plt.subplots()
 
-    sns.kdeplot(data=dribose_heights, linewidth=1, color='b', label='D-Ribose')
-    sns.kdeplot(data=lribose_heights, linewidth=1, color='r', label='L-Ribose')
+    #binned kde, every height of every sim goes into a fixed size grid
+    plot_kde(ax, dribose_heights, linewidth=1, color='b', label='D-Ribose')
+    plot_kde(ax, lribose_heights, linewidth=1, color='r', label='L-Ribose')
     ax.legend(['D-Ribose','L-Ribose'])
     ax.set_xlabel('Height Above Sheet (nm)')
     ax.set_ylabel('PDF')
     ax.set_title('Probability Density of height of ribose')
-    plt.show()
+    save_figure(fig, outfile)
 
-def compute_hbonds(chunk, hbond_counts):
+def compute_hbonds(chunk, hbond_counts, registry=None):
+    registry = registry or get_registry(chunk.topology)
+    G, C, DRI, LRI = (registry.class_index(name) for name in ('G', 'C', 'DRI', 'LRI'))
+    n_classes = len(registry.class_names)
 
     D_G,D_C,D_B,L_G,L_C,L_B,D_D,D_L,L_L = [],[],[],[],[],[],[],[],[]
 
     for frame in chunk:
-        DG = 0
-        DC = 0
-        LG = 0
-        LC = 0
-        DD = 0
-        DL = 0
-        LL = 0
-        hbonds = md.baker_hubbard(frame,exclude_water=True)
-        
-        #get hbond counts 
-        for hbond in hbonds:
-            atom1, atom2 = hbond[0], hbond[2]
-            res1, res2 = frame.topology.atom(atom1).residue, frame.topology.atom(atom2).residue
-            atom1_index, atom2_index = frame.topology.atom(atom1).index % res1.n_atoms, frame.topology.atom(atom2).index % res2.n_atoms
-
-            if (res1.name == 'G' and res2.name == 'DRI') or (res1.name == 'DRI' and res2.name == 'G'):
-                DG += 1
-            elif (res1.name == 'C' and res2.name == 'DRI') or (res1.name == 'DRI' and res2.name == 'C'):
-                DC+= 1
-            elif (res1.name == 'G' and res2.name == 'LRI') or (res1.name == 'LRI' and res2.name == 'G'):
-                LG += 1
-            elif (res1.name == 'C' and res2.name == 'LRI') or (res1.name == 'LRI' and res2.name == 'C'):
-                LC += 1
-            elif (res1.name == 'DRI' and res2.name == 'DRI'):
-                DD += 1
-            elif (res1.name == 'DRI' and res2.name == 'LRI') or (res1.name == 'LRI' and res2.name == 'DRI'):
-                DL += 1
-            elif (res1.name == 'LRI' and res2.name == 'LRI'):
-                LL += 1
-
-            hbond_key = f'{res1.name}-{res2.name}'
-            hbond_count_key = f"{atom1_index}-{atom2_index}"
-
-            if hbond_key not in hbond_counts:
-                hbond_counts[hbond_key] = dict()
-            if hbond_count_key not in hbond_counts[hbond_key]:
-                hbond_counts[hbond_key][hbond_count_key]=0
-            hbond_counts[hbond_key][hbond_count_key] += 1
-
-        D_G.append(DG)
-        D_C.append(DC)
-        D_B.append(DG+DC)
-        L_G.append(LG)
-        L_C.append(LC)
-        L_B.append(LG+LC)
-        D_D.append(DD)
-        D_L.append(DL)
-        L_L.append(LL)
+        hbonds = np.asarray(md.baker_hubbard(frame,exclude_water=True)).reshape(-1, 3)
+        donors, acceptors = hbonds[:, 0], hbonds[:, 2]
+
+        #hbond counts between residue classes, unclassified residues are dropped
+        class1, class2 = registry.atom_class[donors], registry.atom_class[acceptors]
+        known = (class1 >= 0) & (class2 >= 0)
+        pairs = np.bincount(class1[known] * n_classes + class2[known], minlength=n_classes**2).reshape(n_classes, n_classes)
+        pairs = pairs + pairs.T - np.diag(np.diag(pairs))
+
+        #per atom counts keyed by residue class and the atom's index within its residue
+        for atom1, atom2 in zip(donors, acceptors):
+            hbond_key = f'{registry.atom_label[atom1]}-{registry.atom_label[atom2]}'
+            hbond_count_key = f"{registry.atom_offset[atom1]}-{registry.atom_offset[atom2]}"
+            bond_dict = hbond_counts.setdefault(hbond_key, dict())
+            bond_dict[hbond_count_key] = bond_dict.get(hbond_count_key, 0) + 1
+
+        D_G.append(pairs[G, DRI])
+        D_C.append(pairs[C, DRI])
+        D_B.append(pairs[G, DRI] + pairs[C, DRI])
+        L_G.append(pairs[G, LRI])
+        L_C.append(pairs[C, LRI])
+        L_B.append(pairs[G, LRI] + pairs[C, LRI])
+        D_D.append(pairs[DRI, DRI])
+        D_L.append(pairs[DRI, LRI])
+        L_L.append(pairs[LRI, LRI])
             
     return hbond_counts, D_G, D_C, D_B, L_G, L_C, L_B, D_D, D_L, L_L
 
@@ -127,7 +124,8 @@ def ribose_label_sort(item):
     else:
         return (4, int(item[2:]))
 
-def hbond_heatmap(hbond_counts):
+def hbond_heatmap(hbond_counts, outfile='hbond_heatmap.png'):
+    plt = pyplot()
 
     dribose_donor_labels = set()
     dribose_acceptor_labels = set()
@@ -206,36 +204,33 @@ def hbond_heatmap(hbond_counts):
     
     plt.tight_layout()
     plt.suptitle('Hydrogen Bond Heat Map')
-    plt.show()
+    save_figure(fig, outfile)
 
-def hbond_order(D_G,D_C,D_B,L_G,L_C,L_B,D_D,D_L,L_L):
-    D_G = np.mean(D_G,axis=0)/12
-    D_C = np.mean(D_C, axis=0)/12
-    D_B = np.mean(D_B, axis=0)/12
-    L_G = np.mean(L_G, axis=0)/18
-    L_C = np.mean(L_C, axis=0)/18
-    L_B = np.mean(L_B, axis=0)/18
-    D_D = np.mean(D_D, axis=0)/12
-    D_L = np.mean(D_L, axis=0)/30
-    L_L = np.mean(L_L, axis=0)/18
+def hbond_order(store, outfile='hbond_order.png'):
+    plt = pyplot()
 
-    time = np.arange(len(D_G)) * 0.004
+    #mean over sims of the hbonds per molecule, using each sim's own molecule counts
+    means = store.aggregate('hbonds', HBOND_GROUPS, HBOND_NORMALIZE, index='time')
+    D_G,D_C,D_B,L_G,L_C,L_B,D_D,D_L,L_L = (means[group].to_numpy() for group in HBOND_GROUPS)
+
+    #trajectory time is in ps
+    time = means.index.to_numpy() / 1000
 
     fig, ax = plt.subplots(3,3)
-    ax[0,0].plot(time, D_G, linewidth=1, color='b', label='D-Ribose')
-    ax[0,0].plot(time, L_G, linewidth=1, color='r', label='L-Ribose')
+    plot_series(ax[0,0], time, D_G, linewidth=1, color='b', label='D-Ribose', downsample=minmax)
+    plot_series(ax[0,0], time, L_G, linewidth=1, color='r', label='L-Ribose', downsample=minmax)
     ax[0,0].set_title('Guanine H-Bonds')
     ax[0,0].set_xlabel('Time (ns)')
     ax[0,0].set_ylabel('Count')
 
-    ax[1,0].plot(time, D_C, linewidth=1, color='b', label='D-Ribose')
-    ax[1,0].plot(time, L_C, linewidth=1, color='r', label='L-Ribose')
+    plot_series(ax[1,0], time, D_C, linewidth=1, color='b', label='D-Ribose', downsample=minmax)
+    plot_series(ax[1,0], time, L_C, linewidth=1, color='r', label='L-Ribose', downsample=minmax)
     ax[1,0].set_title('Cytosine H-Bonds')
     ax[1,0].set_xlabel('Time (ns)')
     ax[1,0].set_ylabel('Count')
 
-    ax[2,0].plot(time, D_B, linewidth=1, color='b', label='D-Ribose')
-    ax[2,0].plot(time, L_B, linewidth=1, color='r', label='L-Ribose')
+    plot_series(ax[2,0], time, D_B, linewidth=1, color='b', label='D-Ribose', downsample=minmax)
+    plot_series(ax[2,0], time, L_B, linewidth=1, color='r', label='L-Ribose', downsample=minmax)
     ax[2,0].set_title('Guanine and Cytosine H-Bonds')
     ax[2,0].set_xlabel('Time (ns)')
     ax[2,0].set_ylabel('Count')
@@ -256,58 +251,47 @@ def hbond_order(D_G,D_C,D_B,L_G,L_C,L_B,D_D,D_L,L_L):
     ax[2,1].set_title('Distribution of Sheet H-Bonds')
     ax[2,1].set_xlabel('Number of H-Bonds')
 
-    ax[0,2].plot(time, D_D, linewidth=1, color='b', label='D-Ribose')
-    ax[0,2].plot(time, L_L, linewidth=1, color='r', label='L-Ribose')
+    plot_series(ax[0,2], time, D_D, linewidth=1, color='b', label='D-Ribose', downsample=minmax)
+    plot_series(ax[0,2], time, L_L, linewidth=1, color='r', label='L-Ribose', downsample=minmax)
     ax[0,2].set_title('Self-Ribose H-Bonds')
     ax[0,2].set_xlabel('Time (ns)')
     ax[0,2].set_ylabel('Count')
 
-    ax[1,2].plot(time, D_L, linewidth=1, color='m')
+    plot_series(ax[1,2], time, D_L, linewidth=1, color='m', downsample=minmax)
     ax[1,2].set_title('D to L Ribose H-Bonds')
     ax[1,2].set_xlabel('Time (ns)')
     ax[1,2].set_ylabel('Count')
 
     plt.legend()
     plt.tight_layout()
-    plt.show()
-
-def nematic_order(traj):
-    dribose_indices_list = []  
-    lribose_indices_list = []  
-
-    for residue in traj.topology.residues:
-        if residue.name == 'DRI':
-            dribose_indices = [atom.index for atom in residue.atoms]
-            dribose_indices_list.append(dribose_indices) 
-        elif residue.name == 'LRI':
-            lribose_indices = [atom.index for atom in residue.atoms]
-            lribose_indices_list.append(lribose_indices) 
+    save_figure(fig, outfile)
 
-    dribose_order_list = [] 
-    lribose_order_list = []  
+def nematic_order(traj, registry=None):
+    registry = registry or get_registry(traj.topology)
 
-    for dribose_indices in dribose_indices_list:
-        dribose_order = md.compute_nematic_order(traj, indices=dribose_indices_list)
-        dribose_order_list.append(dribose_order) 
-
-    for lribose_indices in lribose_indices_list:
-        lribose_order = md.compute_nematic_order(traj, indices=lribose_indices_list)
-        lribose_order_list.append(lribose_order)
+    # one order parameter per frame over all residues of an enantiomer
+    orders = []
+    for name in ('DRI', 'LRI'):
+        residue_atoms = registry.residue_atoms(name)
+        if residue_atoms:
+            orders.append(md.compute_nematic_order(traj, indices=residue_atoms))
+        else:
+            orders.append(np.full(traj.n_frames, np.nan))
 
-    dribose_order_list = np.mean(dribose_order_list, axis=0)
-    lribose_order_list = np.mean(lribose_order_list, axis=0)
+    return orders[0], orders[1]
 
-    return dribose_order_list, lribose_order_list
+def graph_nematic_order(store, outfile='nematic_order.png'):
+    plt = pyplot()
 
-def graph_nematic_order(dribose_order, lribose_order):
-    dribose_order = np.mean(dribose_order, axis=0)
-    lribose_order = np.mean(lribose_order, axis=0)
+    means = store.aggregate('nematic order', ['DRI', 'LRI'], index='time')
+    dribose_order, lribose_order = means['DRI'].to_numpy(), means['LRI'].to_numpy()
 
-    time = np.arange(len(dribose_order)) * 0.004
+    #trajectory time is in ps
+    time = means.index.to_numpy() / 1000
 
     fig, ax = plt.subplots(2,1)
-    ax[0].plot(time, dribose_order, color='b', linewidth=1, label='D-ribose')
-    ax[0].plot(time, lribose_order, color='r', linewidth=1, label='L-ribose')
+    plot_series(ax[0], time, dribose_order, color='b', linewidth=1, label='D-ribose')
+    plot_series(ax[0], time, lribose_order, color='r', linewidth=1, label='L-ribose')
     ax[0].set_xlabel('Time (ns)')
     ax[0].set_ylabel('Nematic Order Parameter')
     ax[0].legend()
@@ -318,22 +302,15 @@ def graph_nematic_order(dribose_order, lribose_order):
     ax[1].legend()
     
     plt.suptitle('Nematic Order of Ribose Enantiomers')
-    plt.show()
+    save_figure(fig, outfile)
 
-def sasa(traj):
-    DRI_res_indices = []
-    LRI_res_indices = []
-
-    for residue in traj.topology.residues: 
-        if residue.name == 'DRI':
-            DRI_res_indices.append(residue.index)
-        elif residue.name == 'LRI':
-            LRI_res_indices.append(residue.index)
+def sasa(traj, registry=None):
+    registry = registry or get_registry(traj.topology)
 
     sasa = md.shrake_rupley(traj, mode='residue')
     
-    DRI_sasa = sasa[:, DRI_res_indices]
-    LRI_sasa = sasa[:, LRI_res_indices]
+    DRI_sasa = sasa[:, registry.residues('DRI')]
+    LRI_sasa = sasa[:, registry.residues('LRI')]
 
     return DRI_sasa, LRI_sasa
 
@@ -344,99 +321,138 @@ def autocorr(x):
     result = result[result.size//2:]
     return result / result[0]
 
-def graph_sasa(DRI_sasa, LRI_sasa):
-    DRI_sasa = np.array(DRI_sasa)
-    LRI_sasa = np.array(LRI_sasa)
-
-    DRI_sasa_tot_sims = np.concatenate(DRI_sasa, axis=1)
-    LRI_sasa_tot_sims = np.concatenate(LRI_sasa, axis=1)
-
-    DRI_sasa_tot =np.concatenate(DRI_sasa_tot_sims)
-    LRI_sasa_tot = np.concatenate(LRI_sasa_tot_sims)
-
-    sns.kdeplot(data=DRI_sasa_tot, linewidth=1, color='b', label='D-Ribose')
-    sns.kdeplot(data=LRI_sasa_tot, linewidth=1, color='r', label='L-Ribose')
-    plt.yscale('log')
-    plt.xlabel('Solvent Accessible Surface Area (nm^2)')
-    plt.ylabel('log density')
-    plt.title('KDE of SASA')
-    plt.legend()
-    plt.show()
+def graph_sasa(store, outfile='sasa.png'):
+    plt = pyplot()
 
-def main():
-    config = get_config()
-    sims = int(config.get('Input Setup','number sims'))
-    sim_length = int(config.get('Input Setup','number steps'))
-    lconc = int(config.get('Input Setup','lconc'))
+    #every residue of every frame of every sim
+    DRI_sasa_tot = store.values('sasa', 'DRI')
+    LRI_sasa_tot = store.values('sasa', 'LRI')
 
-    indir = config.get('Input Setup','input directory')
+    fig, ax = plt.subplots()
+    plot_kde(ax, DRI_sasa_tot, linewidth=1, color='b', label='D-Ribose')
+    plot_kde(ax, LRI_sasa_tot, linewidth=1, color='r', label='L-Ribose')
+    ax.set_yscale('log')
+    ax.set_xlabel('Solvent Accessible Surface Area (nm^2)')
+    ax.set_ylabel('log density')
+    ax.set_title('KDE of SASA')
+    ax.legend()
+    save_figure(fig, outfile)
+
+def main(config_file='analysis_config.ini'):
+    config = get_config(config_file)
     outdir = config.get('Output Parameters','output directory')
-
-
-    dribose_heights, lribose_heights = [],[]
-    dribose_order, lribose_order = [],[]
-    sim_DRI_sasa, sim_LRI_sasa = [],[]
-    sim_D_G, sim_D_C, sim_D_B, sim_L_G, sim_L_C, sim_L_B, sim_D_D, sim_D_L, sim_L_L = [],[],[],[],[],[],[],[],[]
-    hbond_counts = dict()
-
-    for sim_number in range(sims):
-        print('Analyzing sim number', sim_number)
-
-        traj = md.iterload(f'{indir}/traj_{sim_number}_lconc_18_steps_{sim_length}.dcd', 
-                            top=f'{indir}/topology_{sim_number}_lconc_18_steps_{sim_length}.pdb')
-        
-        traj_d_order, traj_l_order = [],[]
-        traj_DRI_sasa, traj_LRI_sasa = [],[]
-        D_G,D_C,D_B,L_G,L_C,L_B,D_D,D_L,L_L = [],[],[],[],[],[],[],[],[]
-        for chunk in traj:
-
-            dheight, lheight = compute_heights(chunk)
-            dribose_heights.extend(dheight)
-            lribose_heights.extend(lheight)
-
-            # hbond_counts, traj_D_G, traj_D_C, traj_D_B, traj_L_G, traj_L_C, traj_L_B, traj_D_D, traj_D_L, traj_L_L = compute_hbonds(chunk,hbond_counts)
-        #     D_G.extend(traj_D_G)
-        #     D_C.extend(traj_D_C)
-        #     D_B.extend(traj_D_B)
-        #     L_G.extend(traj_L_G)
-        #     L_C.extend(traj_L_C)
-        #     L_B.extend(traj_L_B)
-        #     D_D.extend(traj_D_D)
-        #     D_L.extend(traj_D_L)
-        #     L_L.extend(traj_L_L)
-
-        #     traj_d_ord, traj_l_ord = nematic_order(chunk)
-        #     traj_d_order.extend(traj_d_ord)
-        #     traj_l_order .extend(traj_l_ord)
-
-            # DRI_sasa, LRI_sasa = sasa(chunk)
-            # traj_DRI_sasa.extend(DRI_sasa)
-            # traj_LRI_sasa.extend(LRI_sasa)
-
-
-        # sim_D_G.append(D_G)
-        # sim_D_C.append(D_C)
-        # sim_D_B.append(D_B)
-        # sim_L_G.append(L_G)
-        # sim_L_C.append(L_C)
-        # sim_L_B.append(L_B)
-        # sim_D_D.append(D_D)
-        # sim_D_L.append(D_L)
-        # sim_L_L.append(L_L)
-
-        # dribose_order.append(traj_d_order)
-        # lribose_order.append(traj_l_order)
-
-        # sim_DRI_sasa.append(traj_DRI_sasa)
-        # sim_LRI_sasa.append(traj_LRI_sasa)
-
-
-    # graph_sasa(sim_DRI_sasa, sim_LRI_sasa)
-    # hbond_heatmap(hbond_counts)
-    # hbond_order(sim_D_G,sim_D_C,sim_D_B,sim_L_G,sim_L_C,sim_L_B,sim_D_D,sim_D_L,sim_L_L)
-    # graph_nematic_order(dribose_order, lribose_order)
-    graph_heights(dribose_heights, lribose_heights)
-    print(hbond_counts)
+    compact_store = config.get('Input Setup','compact store', fallback='False') == 'True'
+    memory_budget = float(config.get('Input Setup','memory budget mb', fallback=512))
+    prefetch_depth = int(config.get('Input Setup','prefetch depth', fallback=2))
+    timer = timer_from_config(config, 'Output Parameters', 'analysis', outdir)
+    groups = groups_from_config(config)
+    analyses = {name: config.get('Analyses', name, fallback=default) == 'True'
+                for name, default in (('heights', 'True'), ('hbonds', 'False'), ('nematic order', 'False'), ('sasa', 'False'), ('clusters', 'False'), ('density maps', 'False'))}
+    cluster_cutoff = float(config.get('Analyses', 'cluster cutoff', fallback=0.6))
+    cluster_mode = config.get('Analyses', 'cluster mode', fallback='com')
+    sheet_cutoff = float(config.get('Analyses', 'sheet cutoff', fallback=0.5))
+    persistence_stride = int(config.get('Analyses', 'persistence stride', fallback=0))
+    density_options = (int(config.get('Analyses', 'density bins', fallback=60)), int(config.get('Analyses', 'density z bins', fallback=50)),
+                       float(config.get('Analyses', 'adsorption height', fallback=0.8)), float(config.get('Analyses', 'density max height', fallback=3.0)))
+    total_density = DensityMaps(*density_options)
+    render_workers = int(config.get('Output Parameters', 'render workers', fallback='') or 0) or None
+
+    #the timings are flushed on exit, also when a sim fails to analyze
+    with timer:
+        store = ResultsStore(f"{outdir}/{config.get('Output Parameters','results file', fallback='analysis_results.h5')}")
+        store.clear()
+        hbond_counts = dict()
+
+        sims = find_sims(config)
+        #sim ids of the results tables, with the run and parameters they came from
+        store.write_sims([{'sim': sim_number, **info} for sim_number, (_, _, info) in enumerate(sims)])
+
+        for sim_number, (dcd, top, info) in enumerate(sims):
+            print('Analyzing sim number', sim_number, info.get('run', ''))
+
+            #with compact store the dcd is decoded once into a memory mapped solute-only array and later runs skip it
+            #the next chunks are read on a background thread while this one is analyzed, read_chunk is the time spent waiting
+            traj = read_chunks(dcd, top, compact_store, memory_budget, prefetch_depth)
+
+            #per frame results are kept in arrays sized from the dcd header and written once per sim
+            results = FrameResults(sim_number, count_frames(dcd))
+            density = DensityMaps(*density_options)
+            frame = 0
+            #closing stops the reader thread when an analysis raises instead of leaving it blocked on a full queue
+            with closing(traj):
+                for chunk in timer.iterate(traj, 'read_chunk'):
+                    #chunks of one trajectory share a topology, so its indices are resolved once
+                    registry = get_registry(chunk.topology, groups)
+                    if frame == 0:
+                        results.set_counts(registry)
+
+                    if analyses['heights']:
+                        with timer.phase('compute_heights'):
+                            dheight, lheight = compute_heights(chunk, registry)
+                        results.add('height', 'DRI', frame, chunk.time, dheight)
+                        results.add('height', 'LRI', frame, chunk.time, lheight)
+
+                    if analyses['hbonds']:
+                        with timer.phase('compute_hbonds'):
+                            hbond_counts, *hbond_series = compute_hbonds(chunk, hbond_counts, registry)
+                        for group, values in zip(HBOND_GROUPS, hbond_series):
+                            results.add('hbonds', group, frame, chunk.time, values)
+
+                    if analyses['nematic order']:
+                        with timer.phase('nematic_order'):
+                            d_order, l_order = nematic_order(chunk, registry)
+                        results.add('nematic order', 'DRI', frame, chunk.time, d_order)
+                        results.add('nematic order', 'LRI', frame, chunk.time, l_order)
+
+                    if analyses['sasa']:
+                        with timer.phase('sasa'):
+                            DRI_sasa, LRI_sasa = sasa(chunk, registry)
+                        results.add('sasa', 'DRI', frame, chunk.time, DRI_sasa)
+                        results.add('sasa', 'LRI', frame, chunk.time, LRI_sasa)
+
+                    if analyses['clusters']:
+                        with timer.phase('clusters'):
+                            metrics = cluster_sugars(chunk, registry, cluster_cutoff, cluster_mode, sheet_cutoff)
+                        for (metric, group), values in metrics.items():
+                            results.add(metric, group, frame, chunk.time, values)
+
+                    if persistence_stride > 0:
+                        with timer.phase('persistence'):
+                            sampled, metrics = persistence(chunk, registry, persistence_stride, frame)
+                        for (metric, group), values in metrics.items():
+                            results.add(metric, group, frame + sampled, chunk.time[sampled], values)
+
+                    if analyses['density maps']:
+                        with timer.phase('density_maps'):
+                            density.add(chunk, registry)
+
+                    frame += chunk.n_frames
+
+            with timer.phase('write_results'):
+                store.write(results)
+                if analyses['density maps']:
+                    density.save(f'{outdir}/density_{sim_number}.npz')
+                    total_density.merge(density)
+
+        #figures only read the results file (or small arrays), so they are drawn side by side in worker processes
+        figures = []
+        if analyses['sasa']:
+            figures.append((graph_sasa, (store,), f'{outdir}/sasa.png'))
+        if analyses['hbonds']:
+            figures.append((hbond_heatmap, (hbond_counts,), f'{outdir}/hbond_heatmap.png'))
+            figures.append((hbond_order, (store,), f'{outdir}/hbond_order.png'))
+            print(hbond_counts)
+        if analyses['nematic order']:
+            figures.append((graph_nematic_order, (store,), f'{outdir}/nematic_order.png'))
+        if analyses['density maps'] and total_density.n_frames:
+            total_density.save(f'{outdir}/density.npz')
+            figures.append((graph_density, (total_density,), f'{outdir}/density.png'))
+        if analyses['heights']:
+            figures.append((graph_heights, (store,), f'{outdir}/heights.png'))
+
+        with timer.phase('render_figures'):
+            for outfile in render_all(figures, render_workers):
+                print('Saved', outfile)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
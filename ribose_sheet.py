@@ -5,28 +5,22 @@ from openmm.app import *
 from openmm import *
 from openmm.unit import *
 from sys import stdout
-from openff.toolkit.topology import Molecule
-from openmmforcefields.generators import GAFFTemplateGenerator
-from openff.units.openmm import to_openmm
 import numpy as np
-import matplotlib.pyplot as plt 
-import numpy as np
-import matplotlib.pyplot as plt
 import mdtraj as md
-import argparse
 import multiprocessing as mp
 from tqdm import tqdm
-import json
-from simtk.openmm import app
 import configparser
-from rdkit import Chem
-from rdkit.Chem import Draw
+from mol_cache import load_molecule
+from profiling import PhaseTimer, TimedReporter, timer_from_config
+from platforms import platform_from_config, platform_metadata, write_metadata
+from relax import relax_and_report
+from sim_files import run_files
 
 
 
-def get_config():
+def get_config(filename='sheet_config.ini'):
     config = configparser.ConfigParser()
-    config.read('sheet_config.ini')
+    config.read(filename)
     return config
     
 def translate_one_axis(mol, step, axis='x'):
@@ -137,19 +131,7 @@ def load_test_mols(filenames, resnames):
     """
     mols = {}
     for filename, resname in zip(filenames, resnames):
-        mol = Molecule.from_file(f'./molecules/{filename}', file_format='sdf')
-        mol.generate_conformers()
-        conf = to_openmm(mol.conformers[0])
-        top = mol.to_topology().to_openmm()
-        top = md.Topology.from_openmm(top)
-        top.residue(0).name = resname
-        top = top.to_openmm()
-        mols[filename] = {
-            "mol":mol,
-            "topology": top,
-            "positions": conf,
-            'resname': resname
-        }
+        mols[filename] = load_molecule(f'./molecules/{filename}', resname)
 
     #align them closer to the center of unit cell
     for mol in filenames:
@@ -160,34 +142,35 @@ def load_test_mols(filenames, resnames):
     return mols
 
 def load_sheet_cell(cell_name, cell_res_names):
-    mol = Molecule.from_file(f'./molecules/{cell_name}', file_format='sdf')
-    mol.generate_conformers()
-    conf = to_openmm(mol.conformers[0])
-    top = mol.to_topology().to_openmm()
-    top = md.Topology.from_openmm(top)
+    # only the residue names are used, so the multi-fragment cell is never charged
+    cell = load_molecule(f'./molecules/{cell_name}', cell_res_names.split(',')[0], charge_method=None)
+    top = md.Topology.from_openmm(cell['topology'])
     for residue in top.residues:
         print(residue.name)
 
-def simulate(jobid, device_idx, config):
-    print(device_idx)
+def build_simulation(jobid, device_idx, config, timer=None):
+    """Places the test molecules, builds the system and minimizes it.
+    Phases are recorded in timer (profiling.PhaseTimer) when one is given.
+
+    Returns
+    =======
+    simulation (openmm.app.Simulation), model (openmm.app.Modeller), precision (str)"""
+    from openmmforcefields.generators import GAFFTemplateGenerator
 
     sh = int(config.get('Sheet Setup','sheet height'))
     sw = int(config.get('Sheet Setup','sheet width'))
-    lconc = int(config.get('Sheet Setup','lconc'))
-    outdir  = config.get('Output Parameters','output directory')
-    report = int(config.get('Output Parameters','report interval'))
-    nsteps = int(config.get('Simulation Setup','number steps'))
     test_mol_names = config.get('Sheet Setup','test molecules').split(',')
     test_resnames = config.get('Sheet Setup','test resnames').split(',')
     num_test_mols = int(config.get('Sheet Setup','num of each mol'))
     cell_name = config.get('Sheet Setup','crystal structure')
     cell_res_names = config.get('Sheet Setup','crystal resnames')
+    timer = timer or PhaseTimer()
 
-    test_mols = load_test_mols(test_mol_names, test_resnames)
+    with timer.phase('load_mols'):
+        test_mols = load_test_mols(test_mol_names, test_resnames)
+        unit_cell = load_sheet_cell(cell_name, cell_res_names)
     test_mol_indices = []
 
-    unit_cell = load_sheet_cell(cell_name, cell_res_names)
-
     # initializing the modeler requires a topology and pos
     # we immediately empty the modeler for use later
     model = Modeller(test_mols[test_mol_names[0]]['topology'],test_mols[test_mol_names[0]]['positions'])
@@ -204,7 +187,8 @@ def simulate(jobid, device_idx, config):
     # sheet_indices = []
     # sheet_indices.append(make_sheet(sh, sw//2 + 1, [mols["guanine"]["topology"], mols["cytosine"]["topology"]], [g, c], model, step=3.5))
     
-    test_mol_indices.append(spawn_test_mols(test_mol_names, test_mols, num_test_mols, model, config))
+    with timer.phase('spawn_test_mols'):
+        test_mol_indices.append(spawn_test_mols(test_mol_names, test_mols, num_test_mols, model, config))
 
     if(config.get('Output Parameters','verbose') == 'True'):
         print("Building system:", jobid)
@@ -221,7 +205,8 @@ def simulate(jobid, device_idx, config):
     # model.addSolvent(forcefield=forcefield, model='tip3p', boxSize=Vec3(sh,sw,6))
     model.topology.setPeriodicBoxVectors(box_size)
 
-    system = forcefield.createSystem(model.topology,nonbondedMethod=NoCutoff, nonbondedCutoff=0.5*nanometer, constraints=HBonds)
+    with timer.phase('createSystem'):
+        system = forcefield.createSystem(model.topology,nonbondedMethod=NoCutoff, nonbondedCutoff=0.5*nanometer, constraints=HBonds)
 
     # create position restraints (thanks peter eastman https://gist.github.com/peastman/ad8cda653242d731d75e18c836b2a3a5)
     restraint = CustomExternalForce('k*((x-x0)^2+(y-y0)^2+(z-z0)^2)')
@@ -237,29 +222,46 @@ def simulate(jobid, device_idx, config):
 
     integrator = LangevinMiddleIntegrator(300*kelvin, 1/picosecond, 0.004*picoseconds)
     model.addExtraParticles(forcefield)
-    platform = Platform.getPlatformByName('CUDA')
-    properties = {'CudaDeviceIndex': str(device_idx), 'CudaPrecision': 'single'}
+    platform, properties, precision = platform_from_config(config, 'Simulation Setup', device_idx)
 
-    simulation = Simulation(model.topology, system, integrator, platform, properties)
-    simulation.context.setPositions(model.positions)
-    simulation.context.setVelocitiesToTemperature(300*kelvin)
+    with timer.phase('createContext'):
+        simulation = Simulation(model.topology, system, integrator, platform, properties)
+        simulation.context.setPositions(model.positions)
+        simulation.context.setVelocitiesToTemperature(300*kelvin)
     # save pre-minimized positions as pdb
     # PDBFile.writeFile(simulation.topology, simulation.context.getState(getPositions=True).getPositions(), open("pre_energy_min.pdb", 'w'))
 
-    simulation.minimizeEnergy()
+    relax_and_report(simulation, config, jobid, timer, properties)
+
+    return simulation, model, precision
+
+def simulate(jobid, device_idx, config):
+    print(device_idx)
+
+    lconc = int(config.get('Sheet Setup','lconc'))
+    outdir  = config.get('Output Parameters','output directory')
+    report = int(config.get('Output Parameters','report interval'))
+    nsteps = int(config.get('Simulation Setup','number steps'))
+
+    with timer_from_config(config, 'Output Parameters', jobid, outdir) as timer:
+        simulation, model, precision = build_simulation(jobid, device_idx, config, timer)
+        dcd_file, topology_file = run_files(outdir, jobid, lconc, nsteps)
+        write_metadata(f'{outdir}/metadata_{jobid}_lconc_{lconc}_steps_{nsteps}.json', platform_metadata(simulation.context, precision))
 
-    simulation.reporters.append(StateDataReporter(f"{outdir}/output{jobid}.txt", report, step=True, potentialEnergy=True, temperature=True, speed=True))
-    with open (f'{outdir}/topology_{jobid}_lconc_{lconc}_steps_{nsteps}.pdb','w') as topology_file:
-        PDBFile.writeFile(simulation.topology, model.positions,topology_file)
+        simulation.reporters.append(StateDataReporter(f"{outdir}/output{jobid}.txt", report, step=True, potentialEnergy=True, temperature=True, speed=True))
+        with open (topology_file,'w') as f:
+            PDBFile.writeFile(simulation.topology, model.positions,f)
 
-    dcd_reporter = DCDReporter(f'{outdir}/traj_{jobid}_lconc_{lconc}_steps_{nsteps}.dcd',report)
-    simulation.reporters.append(dcd_reporter)
+        dcd_reporter = DCDReporter(dcd_file,report)
+        simulation.reporters.append(TimedReporter(dcd_reporter, timer, 'write_trajectory'))
 
-    simulation.step(nsteps)
+        # the step phase includes the reporters, write_trajectory is the part spent in the dcd reporter
+        with timer.phase('step'):
+            simulation.step(nsteps)
 
-def main():
-    config = get_config()
-    total_sims = int(config.get('Simulation Setup','number steps'))
+def main(config_file='sheet_config.ini'):
+    config = get_config(config_file)
+    total_sims = int(config.get('Simulation Setup','number sims'))
     gpus = int(config.get('Simulation Setup','number gpus'))
     proc = int(config.get('Simulation Setup','number processes'))
 
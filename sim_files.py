@@ -0,0 +1,7 @@
+"""Names of the files written by the sheet simulations, shared by the simulation, the
+sweep runner and the analysis so none of them has to import another just for a path."""
+
+def run_files(outdir, jobid, lconc, nsteps):
+    """Trajectory and topology written by ribose_sheet.simulate for one replicate."""
+    return (f'{outdir}/traj_{jobid}_lconc_{lconc}_steps_{nsteps}.dcd',
+            f'{outdir}/topology_{jobid}_lconc_{lconc}_steps_{nsteps}.pdb')
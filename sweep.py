@@ -0,0 +1,209 @@
+"""Parameter sweeps of the sheet simulations.
+
+The [Grid] section of the sweep config lists values for keys of the base sheet config
+('<section>.<key> = value1, value2, ...'). Every combination becomes a run in its own
+directory named by a hash of its parameters, holding the run's sheet_config.ini, a
+params.json describing it and the outputs of its replicates. manifest.json in the sweep
+directory records the state of every replicate, so an interrupted sweep picks up where
+it stopped, and ribose_analysis finds the runs through it instead of by file name.
+"""
+import configparser
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import multiprocessing.connection
+import os
+import time
+
+from sim_files import run_files
+
+# sections and keys of the sheet config that change the simulated system, and so the run hash
+HASHED = {'Sheet Setup': None, 'Minimization': None, 'Simulation Setup': ['number steps']}
+
+def get_config(filename='sweep_config.ini'):
+    config = configparser.ConfigParser()
+    config.read(filename)
+    return config
+
+def expand_grid(sweep):
+    """Every combination of the [Grid] values as {(section, key): value}."""
+    axes = []
+    for name, values in sweep.items('Grid'):
+        section, key = name.split('.', 1)
+        axes.append([((section.strip(), key.strip()), value.strip()) for value in values.split(',') if value.strip()])
+    return [dict(combination) for combination in itertools.product(*axes)]
+
+def section_name(config, section):
+    # section names are case sensitive while configparser lowercases the grid keys
+    return next((name for name in config.sections() if name.lower() == section.lower()), section)
+
+def job_config(base, params, run_dir):
+    config = configparser.ConfigParser()
+    config.read_dict(base)
+    for (section, key), value in params.items():
+        section = section_name(config, section)
+        if not config.has_section(section):
+            config.add_section(section)
+        config.set(section, key, value)
+    config.set('Output Parameters', 'output directory', run_dir)
+    return config
+
+def config_hash(config):
+    """Short hash of the parts of a sheet config that define the simulated system."""
+    hashed = {section: {key: value for key, value in config.items(section) if keys is None or key in keys}
+              for section, keys in HASHED.items() if config.has_section(section)}
+    return hashlib.sha1(json.dumps(hashed, sort_keys=True).encode()).hexdigest()[:12]
+
+def load_manifest(outdir):
+    filename = f'{outdir}/manifest.json'
+    if os.path.exists(filename):
+        with open(filename) as f:
+            return json.load(f)
+    return {'runs': {}}
+
+def save_manifest(outdir, manifest):
+    # written to a temporary file first so an interrupted sweep never leaves a truncated manifest
+    with open(f'{outdir}/manifest.json.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f'{outdir}/manifest.json.tmp', f'{outdir}/manifest.json')
+
+def prepare_runs(sweep, base, outdir, manifest):
+    """Writes the directory, sheet_config.ini and params.json of every grid point and adds
+    it to the manifest. Grid points that resolve to the same system share one run.
+
+    Returns
+    =======
+    configs (dict) - {run hash: configparser.ConfigParser}"""
+    replicates = int(sweep.get('Sweep', 'replicates', fallback=1))
+    configs = {}
+    for params in expand_grid(sweep):
+        params = {(section_name(base, section), key): value for (section, key), value in params.items()}
+        config = job_config(base, params, outdir)
+        run = config_hash(config)
+        if run in configs:
+            continue
+
+        run_dir = f'{outdir}/{run}'
+        os.makedirs(run_dir, exist_ok=True)
+        config = job_config(base, params, run_dir)
+        config.set('Simulation Setup', 'number sims', str(replicates))
+        with open(f'{run_dir}/sheet_config.ini', 'w') as f:
+            config.write(f)
+
+        info = {
+            'run': run,
+            'params': {f'{section}.{key}': value for (section, key), value in params.items()},
+            'lconc': config.get('Sheet Setup', 'lconc'),
+            'number steps': config.get('Simulation Setup', 'number steps'),
+            'replicates': replicates,
+        }
+        with open(f'{run_dir}/params.json', 'w') as f:
+            json.dump(info, f, indent=2)
+
+        entry = manifest['runs'].setdefault(run, {'params': info['params'], 'replicates': {}})
+        for replicate in range(replicates):
+            entry['replicates'].setdefault(str(replicate), {'status': 'pending'})
+        configs[run] = config
+    return configs
+
+def prewarm(configs):
+    """Parameterizes every distinct test molecule of the sweep once, in this process, so the
+    jobs all read the molecule cache instead of each running AM1-BCC. The crystal cell is
+    loaded uncharged and is cheap, so it is left to the jobs."""
+    from mol_cache import load_molecule
+
+    molecules = set()
+    for config in configs.values():
+        names = config.get('Sheet Setup', 'test molecules').split(',')
+        resnames = config.get('Sheet Setup', 'test resnames').split(',')
+        molecules.update(zip(names, resnames))
+
+    for filename, resname in sorted(molecules):
+        print('Preparing', filename)
+        load_molecule(f'./molecules/{filename}', resname)
+
+def run_job(run_dir, replicate, device_idx):
+    import numpy as np
+    import ribose_sheet
+
+    config = get_config(f'{run_dir}/sheet_config.ini')
+    # forked jobs inherit one random state, seed from the run and replicate so placements differ but are reproducible
+    np.random.seed((int(os.path.basename(run_dir), 16) + replicate) % 2**32)
+    ribose_sheet.simulate(replicate, device_idx, config)
+
+def schedule(jobs, configs, outdir, manifest, gpus, per_gpu):
+    """Runs (run, replicate) jobs with at most per_gpu processes on each of gpus devices,
+    recording every start and finish in the manifest."""
+    running = {}
+    load = [0] * gpus
+
+    while jobs or running:
+        while jobs and min(load) < per_gpu:
+            run, replicate = jobs.pop(0)
+            device = load.index(min(load))
+            p = mp.Process(target=run_job, args=(configs[run].get('Output Parameters', 'output directory'), replicate, device))
+            p.start()
+            running[p.sentinel] = (p, run, replicate, device)
+            load[device] += 1
+            manifest['runs'][run]['replicates'][str(replicate)] = {'status': 'running', 'device': device, 'started': time.time()}
+            save_manifest(outdir, manifest)
+
+        for sentinel in mp.connection.wait(list(running)):
+            p, run, replicate, device = running.pop(sentinel)
+            p.join()
+            load[device] -= 1
+            record = manifest['runs'][run]['replicates'][str(replicate)]
+            record.update({'status': 'done' if p.exitcode == 0 else 'failed', 'finished': time.time()})
+            save_manifest(outdir, manifest)
+            print(f"Run {run} replicate {replicate}: {record['status']}")
+
+def main(config_file='sweep_config.ini'):
+    sweep = get_config(config_file)
+    base = get_config(sweep.get('Sweep', 'base config', fallback='sheet_config.ini'))
+    outdir = sweep.get('Sweep', 'output directory', fallback='sweep')
+    gpus = int(sweep.get('Sweep', 'number gpus', fallback=1))
+    per_gpu = int(sweep.get('Sweep', 'processes per gpu', fallback=1))
+    os.makedirs(outdir, exist_ok=True)
+
+    manifest = load_manifest(outdir)
+    configs = prepare_runs(sweep, base, outdir, manifest)
+    save_manifest(outdir, manifest)
+    prewarm(configs)
+
+    # replicates that finished in an earlier invocation are skipped, failed or interrupted ones rerun
+    jobs = [(run, int(replicate)) for run in configs for replicate, record in manifest['runs'][run]['replicates'].items()
+            if record['status'] != 'done']
+    print(f'{len(configs)} runs, {len(jobs)} replicates to simulate')
+    schedule(jobs, configs, outdir, manifest, gpus, per_gpu)
+
+def discover_runs(indir):
+    """Runs of a sweep under indir, from manifest.json or the params.json of every run
+    directory. Each run is its params.json plus 'directory' and the 'sims' that have a
+    trajectory, as (replicate, dcd, topology).
+
+    Returns
+    =======
+    runs (list) - empty if indir is not a sweep"""
+    manifest = load_manifest(indir)
+    names = list(manifest['runs']) or sorted(name for name in os.listdir(indir) if os.path.exists(f'{indir}/{name}/params.json'))
+
+    runs = []
+    for name in names:
+        run_dir = f'{indir}/{name}'
+        if not os.path.exists(f'{run_dir}/params.json'):
+            continue
+        with open(f'{run_dir}/params.json') as f:
+            info = json.load(f)
+
+        status = manifest['runs'].get(name, {}).get('replicates', {})
+        info['directory'] = run_dir
+        info['sims'] = [(replicate, *run_files(run_dir, replicate, info['lconc'], info['number steps']))
+                        for replicate in range(info['replicates'])
+                        if status.get(str(replicate), {}).get('status', 'done') == 'done'
+                        and os.path.exists(run_files(run_dir, replicate, info['lconc'], info['number steps'])[0])]
+        runs.append(info)
+    return runs
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,67 @@
+import numpy as np
+import pytest
+
+md = pytest.importorskip('mdtraj')
+pytest.importorskip('scipy')
+
+from clustering import cluster_sugars, connected_components, neighbor_pairs
+from topology_registry import TopologyRegistry
+
+BOX = 3.0
+
+def one_atom_residues(resnames):
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for resname in resnames:
+        topology.add_atom('C1', md.element.carbon, topology.add_residue(resname, chain))
+    return topology
+
+def trajectory(topology, xyz):
+    xyz = np.asarray(xyz, dtype=np.float32)
+    return md.Trajectory(xyz, topology, unitcell_lengths=np.full((len(xyz), 3), BOX), unitcell_angles=np.full((len(xyz), 3), 90.0))
+
+def test_neighbor_pairs_across_the_periodic_boundary():
+    points = np.array([[[0.1, 1.0, 1.0], [2.9, 1.0, 1.0], [1.5, 1.5, 1.5]]])
+    frame, i, j = neighbor_pairs(points, np.full(3, BOX), 0.5)
+    assert list(zip(frame, i, j)) == [(0, 0, 1)]
+    # without a box the two points are 2.8 nm apart
+    assert len(neighbor_pairs(points, None, 0.5)[0]) == 0
+
+def test_neighbor_pairs_never_pair_frames():
+    # the same point in every frame, close to itself across frames only
+    points = np.tile([[[1.0, 1.0, 1.0], [2.0, 2.0, 2.0]]], (4, 1, 1))
+    frame, i, j = neighbor_pairs(points, np.full(3, BOX), 0.5)
+    assert len(frame) == 0
+
+def test_connected_components():
+    labels = connected_components(7, np.array([0, 1, 4]), np.array([1, 2, 5]))
+    np.testing.assert_array_equal(labels, [0, 0, 0, 3, 4, 4, 6])
+
+@pytest.mark.parametrize('mode', ['com', 'atoms'])
+def test_cluster_sugars(mode):
+    topology = one_atom_residues(['G', 'DRI', 'LRI', 'DRI'])
+    # a D/L pair bonded across the x boundary on the sheet and an isolated D-ribose above it
+    traj = trajectory(topology, [[[1.5, 1.5, 1.0], [0.1, 1.0, 1.0], [2.9, 1.0, 1.0], [1.5, 1.5, 2.0]]] * 2)
+    metrics = cluster_sugars(traj, TopologyRegistry(topology), cutoff=0.5, mode=mode, sheet_cutoff=0.5)
+
+    expected = {
+        ('largest cluster', 'sugar'): 2,
+        ('clusters', 'sugar'): 1,
+        ('mixed fraction', 'sugar'): 1.0,
+        ('DL contact fraction', 'sugar'): 1.0,
+        ('clustered fraction', 'DRI'): 0.5,
+        ('clustered fraction', 'LRI'): 1.0,
+        ('on sheet', 'DRI'): 0.5,
+        ('on sheet', 'LRI'): 1.0,
+    }
+    assert set(metrics) == set(expected)
+    for key, value in expected.items():
+        np.testing.assert_allclose(metrics[key], [value, value], err_msg=str(key))
+
+def test_isolated_sugars_form_no_clusters():
+    topology = one_atom_residues(['DRI', 'LRI'])
+    traj = trajectory(topology, [[[0.5, 0.5, 0.5], [2.0, 2.0, 2.0]]])
+    metrics = cluster_sugars(traj, TopologyRegistry(topology), cutoff=0.5)
+    assert metrics['largest cluster', 'sugar'][0] == 1
+    assert metrics['clusters', 'sugar'][0] == 0
+    assert np.isnan(metrics['DL contact fraction', 'sugar'][0])
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+md = pytest.importorskip('mdtraj')
+
+from density import DensityMaps
+from topology_registry import TopologyRegistry
+
+BOX = 3.0
+
+def sugar_system(n_frames, seed=0):
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for resname in ['G', 'DRI', 'DRI', 'LRI']:
+        topology.add_atom('C1', md.element.carbon, topology.add_residue(resname, chain))
+
+    rng = np.random.default_rng(seed)
+    xyz = rng.uniform(0, BOX, (n_frames, 4, 3)).astype(np.float32)
+    xyz[:, 0] = [1.5, 1.5, 1.0]
+    traj = md.Trajectory(xyz, topology, unitcell_lengths=np.full((n_frames, 3), BOX), unitcell_angles=np.full((n_frames, 3), 90.0))
+    return traj, TopologyRegistry(topology)
+
+def test_merge_equals_one_pass():
+    traj, registry = sugar_system(20)
+    whole = DensityMaps(bins=10, z_bins=8, adsorption_height=0.8, max_height=1.5)
+    whole.add(traj, registry)
+
+    first, second = DensityMaps(10, 8, 0.8, 1.5), DensityMaps(10, 8, 0.8, 1.5)
+    first.add(traj[:7], registry)
+    second.add(traj[7:], registry)
+    merged = first.merge(second)
+
+    assert merged.n_frames == whole.n_frames == 20
+    np.testing.assert_allclose(merged.surface, whole.surface)
+    np.testing.assert_allclose(merged.occupancy, whole.occupancy)
+    np.testing.assert_allclose(merged.surface_density(), whole.surface_density())
+
+def test_merge_rejects_other_bins():
+    with pytest.raises(ValueError):
+        DensityMaps(10, 8).merge(DensityMaps(12, 8))
+
+def test_normalization():
+    # every sugar sits 0.5 nm above the sheet in every frame
+    traj, registry = sugar_system(5)
+    traj.xyz[:, 1:, 2] = 1.5
+    maps = DensityMaps(bins=6, z_bins=10, adsorption_height=0.8, max_height=2.0)
+    maps.add(traj, registry)
+
+    area = BOX * BOX / maps.bins**2
+    # sugars per frame: two D-riboses and one L-ribose
+    np.testing.assert_allclose(maps.surface_density().sum(axis=(1, 2)) * area, [2, 1], rtol=1e-6)
+    np.testing.assert_allclose(maps.height_profile().sum(axis=1) * maps.max_height / maps.z_bins, [2, 1], rtol=1e-6)
+
+def test_save_and_load(tmp_path):
+    traj, registry = sugar_system(4)
+    maps = DensityMaps(bins=5, z_bins=4)
+    maps.add(traj, registry)
+    maps.save(tmp_path / 'density.npz')
+
+    loaded = DensityMaps.load(tmp_path / 'density.npz')
+    assert loaded.n_frames == 4 and loaded.classes == maps.classes
+    np.testing.assert_allclose(loaded.surface_density(), maps.surface_density())
@@ -0,0 +1,21 @@
+import subprocess
+import sys
+
+from benchmarks.import_time import parse_importtime
+
+LOG = '''import time: self [us] | cumulative | imported package
+import time:       327 |        327 |   _io
+import time:       529 |       1543 | _frozen_importlib_external
+import time:        69 |         69 |     _codecs
+import time:       200 |        600 |   json.decoder
+import time:       400 |       1000 | json
+'''
+
+def test_only_top_level_imports_are_counted():
+    assert parse_importtime(LOG) == {'_frozen_importlib_external': 1543e-6, 'json': 1000e-6}
+
+def test_nested_modules_of_a_real_import_are_skipped():
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import json'], capture_output=True, text=True)
+    packages = parse_importtime(result.stderr)
+    assert 'json' in packages
+    assert 'json.decoder' not in packages
@@ -0,0 +1,36 @@
+import json
+
+import pytest
+
+from profiling import PhaseTimer, reset_peak_rss
+
+pytestmark = pytest.mark.skipif(not reset_peak_rss(), reason='the rss high-water mark can only be reset on linux')
+
+def allocate(mb):
+    data = b'x' * (mb * 2**20)
+    return len(data)
+
+def test_peak_is_per_phase(tmp_path):
+    timer = PhaseTimer(str(tmp_path / 'timings.jsonl'), 'job')
+    with timer.phase('large'):
+        allocate(200)
+    with timer.phase('small'):
+        allocate(1)
+    assert timer.phases['large']['peak rss MB'] > timer.phases['small']['peak rss MB'] + 150
+
+def test_nested_phase_counts_toward_its_parent(tmp_path):
+    timer = PhaseTimer(str(tmp_path / 'timings.jsonl'), 'job')
+    with timer.phase('outer'):
+        allocate(200)
+        with timer.phase('inner'):
+            allocate(1)
+    assert timer.phases['outer']['peak rss MB'] > timer.phases['inner']['peak rss MB'] + 150
+
+def test_flush_on_failure(tmp_path):
+    filename = tmp_path / 'timings.jsonl'
+    with pytest.raises(ValueError):
+        with PhaseTimer(str(filename), 'job') as timer:
+            with timer.phase('crash'):
+                raise ValueError
+    records = [json.loads(line) for line in filename.read_text().splitlines()]
+    assert [record['phase'] for record in records] == ['crash']
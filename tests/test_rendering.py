@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+from rendering import binned_kde, lttb, minmax, render_all
+
+def test_lttb_length_and_endpoints():
+    x = np.arange(10000, dtype=float)
+    y = np.sin(x / 50)
+    dx, dy = lttb(x, y, 500)
+    assert len(dx) == len(dy) == 500
+    assert (dx[0], dx[-1]) == (x[0], x[-1])
+    assert np.all(np.diff(dx) > 0)
+
+def test_lttb_short_series_unchanged():
+    x, y = np.arange(10.0), np.arange(10.0) ** 2
+    dx, dy = lttb(x, y, 100)
+    np.testing.assert_array_equal(dx, x)
+    np.testing.assert_array_equal(dy, y)
+
+def test_lttb_drops_nans():
+    x = np.arange(5000, dtype=float)
+    y = np.cos(x / 20)
+    y[::7] = np.nan
+    dx, dy = lttb(x, y, 300)
+    assert len(dx) == 300
+    assert np.all(np.isfinite(dy))
+
+def test_minmax_keeps_spikes():
+    x = np.arange(10000, dtype=float)
+    y = np.zeros(10000)
+    y[1234], y[8765] = 50, -50
+    dx, dy = minmax(x, y, 200)
+    assert len(dx) == 200
+    assert dy.max() == 50 and dy.min() == -50
+    assert np.all(np.diff(dx) >= 0)
+
+def test_binned_kde_integrates_to_one():
+    data = np.random.default_rng(0).normal(1.0, 0.3, 20000)
+    grid, density = binned_kde(data)
+    assert len(grid) == len(density) == 512
+    assert np.sum(density) * (grid[1] - grid[0]) == pytest.approx(1)
+    assert grid[np.argmax(density)] == pytest.approx(1.0, abs=0.05)
+
+def test_binned_kde_degenerate_input():
+    assert all(len(a) == 0 for a in binned_kde([np.nan, 2.0]))
+    assert all(len(a) == 0 for a in binned_kde(np.ones(10)))
+
+def draw(value, outfile):
+    if value < 0:
+        raise ValueError('negative')
+    with open(outfile, 'w') as f:
+        f.write(str(value))
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_render_all_raises_after_every_task(tmp_path, workers):
+    tasks = [(draw, (value,), str(tmp_path / f'{k}.txt')) for k, value in enumerate([1, -1, 2])]
+    with pytest.raises(RuntimeError, match='1 of 3 figures failed'):
+        render_all(tasks, workers)
+    # the figures after the failing one are still drawn
+    assert (tmp_path / '0.txt').exists() and (tmp_path / '2.txt').exists()
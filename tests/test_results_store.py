@@ -0,0 +1,57 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('pandas')
+pytest.importorskip('tables')
+
+from results_store import FrameResults, ResultsStore
+
+class Registry:
+    """Just the part of TopologyRegistry that set_counts reads."""
+    def __init__(self, counts):
+        self.class_names = list(counts)
+        self.counts = counts
+
+    def residues(self, name):
+        return range(self.counts[name])
+
+def sim_results(sim, n_frames, dt, counts, values):
+    results = FrameResults(sim, n_frames)
+    results.set_counts(Registry(counts))
+    time = np.arange(n_frames) * dt
+    # two chunks, to go through the growing arrays
+    half = n_frames // 2
+    for group, series in values.items():
+        results.add('hbonds', group, 0, time[:half], series[:half])
+        results.add('hbonds', group, half, time[half:], series[half:])
+    return results
+
+@pytest.fixture
+def store(tmp_path):
+    store = ResultsStore(str(tmp_path / 'results.h5'))
+    # sim 0: 4 frames 4 ps apart, 2 D-riboses; sim 1: 8 frames 2 ps apart, 4 D-riboses
+    store.write(sim_results(0, 4, 4.0, {'DRI': 2, 'LRI': 1}, {'DRI-G': np.array([2, 4, 6, 8.0]), 'LRI-G': np.ones(4)}))
+    store.write(sim_results(1, 8, 2.0, {'DRI': 4, 'LRI': 0}, {'DRI-G': np.arange(8.0) * 4, 'LRI-G': np.ones(8)}))
+    return store
+
+def test_aggregate_on_frames(store):
+    means = store.aggregate('hbonds', ['DRI-G', 'LRI-G', 'missing'])
+    assert list(means.columns) == ['DRI-G', 'LRI-G', 'missing']
+    assert list(means.index) == list(range(8))
+    # frames 0-3 average both sims, 4-7 only have sim 1
+    np.testing.assert_allclose(means['DRI-G'], [1, 4, 7, 10, 16, 20, 24, 28])
+    assert means['missing'].isna().all()
+
+def test_aggregate_normalized_on_time(store):
+    means = store.aggregate('hbonds', ['DRI-G', 'LRI-G'], {'DRI-G': ['DRI'], 'LRI-G': ['LRI']}, index='time')
+    assert list(means.index) == [0, 2, 4, 6, 8, 10, 12, 14]
+    # per molecule: sim 0 gives 1, 2, 3, 4 at 0, 4, 8, 12 ps and sim 1 gives 0, 1, 2, ... at 0, 2, 4, ... ps
+    np.testing.assert_allclose(means['DRI-G'], [0.5, 1, 2, 3, 3.5, 5, 5, 7])
+    # sim 1 has no L-ribose, its rows are dropped instead of dividing by zero
+    np.testing.assert_allclose(means['LRI-G'].dropna(), [1, 1, 1, 1])
+    assert list(means['LRI-G'].dropna().index) == [0, 4, 8, 12]
+
+def test_write_replaces_the_rows_of_a_sim(store):
+    store.write(sim_results(1, 2, 2.0, {'DRI': 1, 'LRI': 1}, {'DRI-G': np.array([5.0, 5.0])}))
+    assert len(store.values('hbonds', 'DRI-G')) == 4 + 2
+    assert store.counts().loc[1, 'DRI'] == 1
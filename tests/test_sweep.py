@@ -0,0 +1,74 @@
+import configparser
+import json
+import os
+
+from sim_files import run_files
+from sweep import config_hash, discover_runs, expand_grid, load_manifest, prepare_runs, save_manifest
+
+BASE = {
+    'Sheet Setup': {'lconc': '0', 'num of each mol': '10', 'test molecules': 'a.sdf,b.sdf', 'test resnames': 'DRI,LRI'},
+    'Simulation Setup': {'number sims': '1', 'number steps': '1000'},
+    'Output Parameters': {'output directory': '.', 'verbose': 'False'},
+}
+
+def config_from(sections):
+    config = configparser.ConfigParser()
+    config.read_dict(sections)
+    return config
+
+def sweep_config(grid, replicates=2):
+    return config_from({'Sweep': {'replicates': str(replicates)}, 'Grid': grid})
+
+def test_expand_grid():
+    grid = expand_grid(sweep_config({'Sheet Setup.lconc': '0, 5,10', 'Sheet Setup.num of each mol': '10,20'}))
+    assert len(grid) == 6
+    # configparser lowercases the keys, prepare_runs restores the section names
+    assert {params['sheet setup', 'lconc'] for params in grid} == {'0', '5', '10'}
+
+def test_config_hash_ignores_key_order_and_unhashed_keys():
+    reordered = {section: dict(reversed(list(keys.items()))) for section, keys in reversed(list(BASE.items()))}
+    assert config_hash(config_from(BASE)) == config_hash(config_from(reordered))
+
+    verbose = {**BASE, 'Output Parameters': {**BASE['Output Parameters'], 'verbose': 'True'}}
+    assert config_hash(config_from(verbose)) == config_hash(config_from(BASE))
+
+    more = {**BASE, 'Sheet Setup': {**BASE['Sheet Setup'], 'lconc': '5'}}
+    assert config_hash(config_from(more)) != config_hash(config_from(BASE))
+
+def test_prepare_runs(tmp_path):
+    sweep = sweep_config({'Sheet Setup.lconc': '0,5,10', 'Sheet Setup.num of each mol': '10,20', 'Output Parameters.verbose': 'True,False'})
+    manifest = {'runs': {}}
+    configs = prepare_runs(sweep, config_from(BASE), str(tmp_path), manifest)
+
+    # verbose does not change the system, so its two values share a run
+    assert len(configs) == 6
+    for run, config in configs.items():
+        assert config.get('Output Parameters', 'output directory') == f'{tmp_path}/{run}'
+        assert config.get('Simulation Setup', 'number sims') == '2'
+        assert os.path.exists(f'{tmp_path}/{run}/sheet_config.ini')
+        assert set(manifest['runs'][run]['replicates']) == {'0', '1'}
+
+    # a second invocation resolves to the same runs and keeps their state
+    manifest['runs'][run]['replicates']['0']['status'] = 'done'
+    assert set(prepare_runs(sweep, config_from(BASE), str(tmp_path), manifest)) == set(configs)
+    assert manifest['runs'][run]['replicates']['0']['status'] == 'done'
+
+def test_discover_runs(tmp_path):
+    sweep = sweep_config({'Sheet Setup.lconc': '0,5'})
+    manifest = {'runs': {}}
+    configs = prepare_runs(sweep, config_from(BASE), str(tmp_path), manifest)
+    run = sorted(configs)[0]
+
+    # replicate 0 finished, replicate 1 failed after writing part of its trajectory
+    lconc = configs[run].get('Sheet Setup', 'lconc')
+    for replicate, status in ((0, 'done'), (1, 'failed')):
+        open(run_files(f'{tmp_path}/{run}', replicate, lconc, '1000')[0], 'w').close()
+        manifest['runs'][run]['replicates'][str(replicate)]['status'] = status
+    save_manifest(str(tmp_path), manifest)
+    assert load_manifest(str(tmp_path)) == json.loads(json.dumps(manifest))
+
+    runs = {info['run']: info for info in discover_runs(str(tmp_path))}
+    assert set(runs) == set(configs)
+    assert [sim[0] for sim in runs[run]['sims']] == [0]
+    assert runs[run]['params'] == {'Sheet Setup.lconc': lconc}
+    assert all(not info['sims'] for name, info in runs.items() if name != run)
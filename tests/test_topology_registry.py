@@ -0,0 +1,65 @@
+import gc
+
+import numpy as np
+import pytest
+
+md = pytest.importorskip('mdtraj')
+
+from topology_registry import DEFAULT_GROUPS, SHEET, SUGARS, TopologyRegistry, get_registry
+
+def topology(resnames, atoms_per_residue=2):
+    top = md.Topology()
+    chain = top.add_chain()
+    for resname in resnames:
+        residue = top.add_residue(resname, chain)
+        for k in range(atoms_per_residue):
+            top.add_atom(f'C{k}', md.element.carbon, residue)
+    return top
+
+def test_residue_names_map_to_classes():
+    registry = TopologyRegistry(topology(['GUA', 'C', 'DRIB', 'HOH', 'LRI', 'DRI']))
+    np.testing.assert_array_equal(registry.residues(*SHEET), [0, 1])
+    np.testing.assert_array_equal(registry.residues('DRI'), [2, 5])
+    np.testing.assert_array_equal(registry.atoms(*SUGARS), [4, 5, 8, 9, 10, 11])
+    assert registry.residue_class[3] == -1 and registry.atom_label[6] == 'HOH'
+    np.testing.assert_array_equal(registry.atom_offset[:4], [0, 1, 0, 1])
+    assert [list(atoms) for atoms in registry.residue_atoms('DRI')] == [[4, 5], [10, 11]]
+
+def test_residue_centers():
+    registry = TopologyRegistry(topology(['DRI', 'HOH', 'LRI']))
+    xyz = np.arange(2 * 6 * 3, dtype=np.float32).reshape(2, 6, 3)
+    centers = registry.residue_centers(xyz, *SUGARS)
+    np.testing.assert_allclose(centers, np.stack([xyz[:, 0:2].mean(axis=1), xyz[:, 4:6].mean(axis=1)], axis=1))
+
+def test_residue_centers_are_mass_weighted():
+    top = md.Topology()
+    residue = top.add_residue('DRI', top.add_chain())
+    top.add_atom('O1', md.element.oxygen, residue)
+    top.add_atom('H1', md.element.hydrogen, residue)
+    xyz = np.array([[[0.0, 0, 0], [1.0, 0, 0]]], dtype=np.float32)
+
+    center = TopologyRegistry(top).residue_centers(xyz, 'DRI')[0, 0, 0]
+    oxygen, hydrogen = md.element.oxygen.mass, md.element.hydrogen.mass
+    assert center == pytest.approx(hydrogen / (oxygen + hydrogen), rel=1e-5)
+
+def test_cache_keys_on_the_topology():
+    first, second = topology(['DRI', 'LRI']), topology(['DRI', 'LRI'])
+    assert get_registry(first) is get_registry(first)
+    assert get_registry(first) is not get_registry(second)
+    # other groups are another registry of the same topology
+    groups = {**DEFAULT_GROUPS, 'DRI': ['DRIB']}
+    assert get_registry(first, groups) is not get_registry(first)
+    assert len(get_registry(first, groups).residues('DRI')) == 0
+
+def test_cache_drops_collected_topologies():
+    from topology_registry import _registries
+
+    # topologies hold reference cycles, so earlier ones may still wait for the collector
+    gc.collect()
+    before = len(_registries)
+    top = topology(['DRI'])
+    get_registry(top)
+    assert len(_registries) == before + 1
+    del top
+    gc.collect()
+    assert len(_registries) == before
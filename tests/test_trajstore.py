@@ -0,0 +1,92 @@
+import numpy as np
+import pytest
+
+md = pytest.importorskip('mdtraj')
+
+from trajstore import CompactTrajectory, compact, open_store, store_exists
+
+def write_dcd(tmp_path, n_frames=12):
+    topology = md.Topology()
+    chain = topology.add_chain()
+    for resname in ['DRI', 'HOH', 'LRI']:
+        residue = topology.add_residue(resname, chain)
+        for name in ['C1', 'C2', 'O3']:
+            topology.add_atom(name, md.element.get_by_symbol(name[0]), residue)
+
+    rng = np.random.default_rng(1)
+    xyz = rng.uniform(0, 2, (n_frames, topology.n_atoms, 3)).astype(np.float32)
+    traj = md.Trajectory(xyz, topology, unitcell_lengths=np.full((n_frames, 3), 2.0), unitcell_angles=np.full((n_frames, 3), 90.0))
+    dcd = str(tmp_path / 'traj.dcd')
+    traj.save_dcd(dcd)
+    return dcd, traj
+
+def test_round_trip(tmp_path):
+    dcd, traj = write_dcd(tmp_path)
+    prefix = str(tmp_path / 'traj.solute')
+    assert compact(dcd, traj.topology, prefix, selection='not resname HOH', chunk=5) == traj.n_frames
+    assert store_exists(prefix, dcd, 'not resname HOH')
+    assert not store_exists(prefix, dcd, 'all')
+
+    store = CompactTrajectory(prefix)
+    kept = traj.topology.select('not resname HOH')
+    np.testing.assert_array_equal(store.atom_indices, kept)
+
+    chunk = store.slice(3, 9)
+    np.testing.assert_allclose(chunk.xyz, traj.xyz[3:9][:, kept], atol=1e-3)
+    np.testing.assert_allclose(chunk.unitcell_lengths, 2.0, atol=1e-5)
+    assert chunk.xyz.flags.writeable and chunk.xyz.flags.c_contiguous and chunk.xyz.dtype == np.float32
+
+    # kernels and in-place operations that need writable float32 coordinates
+    chunk.superpose(chunk, 0)
+    chunk.center_coordinates()
+    assert md.compute_distances(chunk, [[0, 1]]).shape == (6, 1)
+
+    subset = store.slice(0, 4, atom_indices=[0, 2])
+    assert subset.n_atoms == 2 and subset.xyz.flags.writeable
+    assert sum(len(part) for part in store.iterchunks(5)) == traj.n_frames
+
+def test_open_store_rebuilds_for_another_selection(tmp_path):
+    dcd, traj = write_dcd(tmp_path)
+    assert open_store(dcd, traj.topology, selection='not resname HOH').xyz.shape[1] == 6
+    assert open_store(dcd, traj.topology, selection='all').xyz.shape[1] == 9
+
+def test_prefetch_yields_in_order():
+    from trajstore import prefetch
+    assert list(prefetch(iter(range(50)), depth=3)) == list(range(50))
+
+def test_prefetch_raises_reader_errors():
+    from trajstore import prefetch
+
+    def broken():
+        yield 1
+        yield 2
+        raise OSError('truncated dcd')
+
+    items = []
+    with pytest.raises(OSError, match='truncated dcd'):
+        for item in prefetch(broken(), depth=2):
+            items.append(item)
+    assert items == [1, 2]
+
+def test_prefetch_reader_stops_when_the_consumer_raises():
+    import threading
+    from contextlib import closing
+    from trajstore import prefetch
+
+    produced = []
+    def endless():
+        while True:
+            produced.append(len(produced))
+            yield produced[-1]
+
+    before = threading.active_count()
+    with pytest.raises(RuntimeError):
+        with closing(prefetch(endless(), depth=2)) as chunks:
+            for chunk in chunks:
+                if chunk == 3:
+                    raise RuntimeError('analysis failed')
+    # the reader thread was joined by close, so nothing keeps producing
+    assert threading.active_count() == before
+    count = len(produced)
+    threading.Event().wait(0.3)
+    assert len(produced) == count
@@ -0,0 +1,118 @@
+"""Residue classes of a topology, resolved once and shared by the analysis functions.
+
+The builders name the sheet GUA/CYT (sheet_config.ini crystal resnames) while older
+trajectories and the synthetic benchmarks use G/C, and the sugars are DRI/LRI or
+DRIB/LRIB depending on where they were written. A class groups all the names it may
+appear under, so selections never silently come back empty because of a naming change.
+"""
+import weakref
+
+import numpy as np
+
+DEFAULT_GROUPS = {
+    'G': ['GUA', 'G'],
+    'C': ['CYT', 'C'],
+    'DRI': ['DRI', 'DRIB'],
+    'LRI': ['LRI', 'LRIB'],
+}
+SHEET = ('G', 'C')
+SUGARS = ('DRI', 'LRI')
+
+def groups_from_config(config, section='Residue Groups'):
+    """{class: [residue names]} from a config section, the defaults if it is missing.
+    configparser lowercases keys, class names are upper case."""
+    if not config.has_section(section):
+        return dict(DEFAULT_GROUPS)
+    return {name.upper(): [resname.strip() for resname in value.split(',') if resname.strip()]
+            for name, value in config.items(section)}
+
+class TopologyRegistry:
+    """Index arrays and per-atom lookup tables of one mdtraj topology.
+    Attributes
+    ==========
+    class_names   (list) - residue classes, the position in this list is the class id
+    residue_class (np.ndarray) - class id of every residue, -1 if it is in no class
+    atom_residue  (np.ndarray) - residue index of every atom
+    atom_class    (np.ndarray) - class id of every atom
+    atom_offset   (np.ndarray) - index of every atom within its residue
+    atom_label    (list) - class name of every atom, the residue name if it is in no class
+    atom_mass     (np.ndarray) - mass of every atom (dalton), 0 for virtual sites
+    """
+    def __init__(self, topology, groups=DEFAULT_GROUPS):
+        self.groups = groups
+        self.class_names = list(groups)
+        class_of = {resname: i for i, name in enumerate(self.class_names) for resname in groups[name]}
+
+        residues = list(topology.residues)
+        self.residue_class = np.array([class_of.get(residue.name, -1) for residue in residues], dtype=int)
+        first_atom = np.array([next(iter(residue.atoms)).index if residue.n_atoms else 0 for residue in residues], dtype=int)
+
+        self.atom_residue = np.array([atom.residue.index for atom in topology.atoms], dtype=int)
+        self.atom_mass = np.array([atom.element.mass if atom.element is not None else 0.0 for atom in topology.atoms], dtype=np.float32)
+        self.atom_class = self.residue_class[self.atom_residue]
+        self.atom_offset = np.arange(len(self.atom_residue)) - first_atom[self.atom_residue]
+        residue_label = [self.class_names[c] if c >= 0 else residue.name for c, residue in zip(self.residue_class, residues)]
+        self.atom_label = [residue_label[r] for r in self.atom_residue]
+
+        self._atoms = {}
+        self._centers = {}
+
+        empty = [name for i, name in enumerate(self.class_names) if not np.any(self.residue_class == i)]
+        if empty:
+            print(f"No residues named {', '.join('/'.join(groups[name]) for name in empty)} in this topology")
+
+    def class_index(self, name):
+        return self.class_names.index(name)
+
+    def residues(self, *names):
+        """Residue indices of the given classes."""
+        return np.flatnonzero(np.isin(self.residue_class, [self.class_index(name) for name in names]))
+
+    def atoms(self, *names):
+        """Atom indices of the given classes, cached."""
+        if names not in self._atoms:
+            self._atoms[names] = np.flatnonzero(np.isin(self.atom_class, [self.class_index(name) for name in names]))
+        return self._atoms[names]
+
+    def residue_atoms(self, name):
+        """One array of atom indices per residue of a class."""
+        atoms = self.atoms(name)
+        return np.split(atoms, np.flatnonzero(np.diff(self.atom_residue[atoms])) + 1) if len(atoms) else []
+
+    def residue_centers(self, xyz, *names):
+        """Center of mass of every residue of the given classes in every frame, in the
+        order of residues(*names).
+        Params
+        ======
+        xyz   (np.ndarray) - (n_frames, n_atoms, 3) coordinates
+        names (str) - residue classes
+
+        Returns
+        =======
+        centers (np.ndarray) - (n_frames, n_residues, 3)"""
+        atoms = self.atoms(*names)
+        if names not in self._centers:
+            # mass weighted averaging matrix, atoms x residues
+            _, local = np.unique(self.atom_residue[atoms], return_inverse=True)
+            membership = np.zeros((len(atoms), local.max() + 1 if len(atoms) else 0), dtype=np.float32)
+            membership[np.arange(len(atoms)), local] = 1
+            weights = membership * self.atom_mass[atoms][:, None]
+            # residues without any mass (only virtual sites) fall back to their geometric center
+            massless = weights.sum(axis=0) == 0
+            weights[:, massless] = membership[:, massless]
+            self._centers[names] = weights / np.maximum(weights.sum(axis=0), 1)
+        return np.einsum('fad,ar->frd', xyz[:, atoms], self._centers[names])
+
+_registries = {}
+
+def get_registry(topology, groups=DEFAULT_GROUPS):
+    """The registry of a topology, built on first use. Chunks read from one trajectory
+    share their topology object, so this runs once per trajectory rather than per chunk.
+    Entries are dropped when their topology is garbage collected, before its id can be
+    reused by another topology, and only a weak reference to the topology is kept."""
+    key = (id(topology), tuple((name, tuple(resnames)) for name, resnames in groups.items()))
+    cached = _registries.get(key)
+    if cached is None or cached[0]() is not topology:
+        _registries[key] = (weakref.ref(topology), TopologyRegistry(topology, groups))
+        weakref.finalize(topology, _registries.pop, key, None)
+    return _registries[key][1]
@@ -0,0 +1,206 @@
+import json
+import os
+import queue
+import threading
+
+import numpy as np
+import mdtraj as md
+
+def store_files(prefix):
+    return f'{prefix}.xyz.npy', f'{prefix}.cell.npy', f'{prefix}.time.npy', f'{prefix}.json'
+
+def count_frames(dcd):
+    """Number of frames in the dcd header, nothing is decoded."""
+    with md.formats.DCDTrajectoryFile(dcd) as f:
+        return len(f)
+
+def store_exists(prefix, dcd=None, selection=None):
+    """True if the store is complete and, when dcd is given, newer than the trajectory.
+    When selection is given the store also has to have been written with it."""
+    files = store_files(prefix)
+    if not all(os.path.exists(f) for f in files):
+        return False
+    if dcd is not None and os.path.getmtime(files[-1]) < os.path.getmtime(dcd):
+        return False
+    if selection is not None:
+        with open(files[-1]) as f:
+            return json.load(f).get('selection') == selection
+    return True
+
+def topology_to_dict(topology):
+    """Plain JSON description of an mdtraj topology. Unlike pdb it keeps residue names
+    longer than three characters (DRIB, LRIB)."""
+    return {
+        'chains': [[[residue.name, residue.resSeq, [[atom.name, atom.element.symbol if atom.element else None] for atom in residue.atoms]]
+                    for residue in chain.residues] for chain in topology.chains],
+        'bonds': [[bond[0].index, bond[1].index] for bond in topology.bonds],
+    }
+
+def topology_from_dict(data):
+    topology = md.Topology()
+    for chain_data in data['chains']:
+        chain = topology.add_chain()
+        for resname, resSeq, atoms in chain_data:
+            residue = topology.add_residue(resname, chain, resSeq)
+            for name, symbol in atoms:
+                topology.add_atom(name, md.element.get_by_symbol(symbol) if symbol else None, residue)
+    atoms = list(topology.atoms)
+    for i, j in data['bonds']:
+        topology.add_bond(atoms[i], atoms[j])
+    return topology
+
+def compact(dcd, top, prefix, selection='not water', chunk=1000):
+    """Converts a dcd once into a float32 array of the selected atoms plus unit cells and a
+    topology sidecar, so later analyses can memory map it instead of decoding the dcd.
+    Params
+    ======
+    dcd       (str) - trajectory file
+    top       (str or md.Topology) - topology of the full system
+    prefix    (str) - output files are <prefix>.xyz.npy, .cell.npy, .time.npy and .json
+    selection (str) - mdtraj selection of the atoms to keep, by default everything but water
+    chunk     (int) - frames decoded at a time
+
+    Returns
+    =======
+    n_frames (int)"""
+    topology = top if isinstance(top, md.Topology) else md.load_topology(top)
+    atoms = topology.select(selection)
+
+    n_frames = count_frames(dcd)
+
+    xyz_file, cell_file, time_file, meta_file = store_files(prefix)
+    xyz = np.lib.format.open_memmap(xyz_file, mode='w+', dtype=np.float32, shape=(n_frames, len(atoms), 3))
+    # unit cell lengths followed by angles
+    cell = np.lib.format.open_memmap(cell_file, mode='w+', dtype=np.float32, shape=(n_frames, 6))
+    time = np.lib.format.open_memmap(time_file, mode='w+', dtype=np.float64, shape=(n_frames,))
+
+    frame = 0
+    for traj in md.iterload(dcd, top=topology, chunk=chunk, atom_indices=atoms):
+        n = min(len(traj), n_frames - frame)
+        xyz[frame:frame+n] = traj.xyz[:n]
+        if traj.unitcell_lengths is not None:
+            cell[frame:frame+n, :3] = traj.unitcell_lengths[:n]
+            cell[frame:frame+n, 3:] = traj.unitcell_angles[:n]
+        time[frame:frame+n] = traj.time[:n]
+        frame += n
+    for array in (xyz, cell, time):
+        array.flush()
+
+    # a run that died early leaves fewer frames than the dcd header promises
+    with open(meta_file, 'w') as f:
+        json.dump({
+            'source': os.path.abspath(dcd),
+            'selection': selection,
+            'atom_indices': atoms.tolist(),
+            'n_frames': frame,
+            'topology': topology_to_dict(topology.subset(atoms)),
+        }, f)
+
+    return frame
+
+class CompactTrajectory:
+    """Read-only view of a store written by compact(). Frames are sliced straight out of the
+    memory mapped arrays, so only the pages that are touched are read from disk."""
+    def __init__(self, prefix):
+        xyz_file, cell_file, time_file, meta_file = store_files(prefix)
+        with open(meta_file) as f:
+            meta = json.load(f)
+
+        self.n_frames = meta['n_frames']
+        self.atom_indices = np.array(meta['atom_indices'])
+        self.topology = topology_from_dict(meta['topology'])
+        self.time = np.load(time_file, mmap_mode='r')[:self.n_frames]
+        self.xyz = np.load(xyz_file, mmap_mode='r')[:self.n_frames]
+        self.cell = np.load(cell_file, mmap_mode='r')[:self.n_frames]
+
+    def __len__(self):
+        return self.n_frames
+
+    def slice(self, start, stop, atom_indices=None):
+        """Frames [start, stop) as an md.Trajectory, optionally restricted to atom_indices
+        (indices into the stored atoms). Only the pages of those frames are read, and they
+        are copied into writable arrays, since mdtraj kernels and in-place operations
+        (superpose, center_coordinates) reject the read-only memory map."""
+        xyz = self.xyz[start:stop]
+        topology = self.topology
+        if atom_indices is not None:
+            xyz = xyz[:, atom_indices]
+            topology = topology.subset(atom_indices)
+        xyz = np.require(xyz, dtype=np.float32, requirements='CW')
+
+        cell = np.array(self.cell[start:stop], dtype=np.float32)
+        has_cell = np.any(cell[:, :3] > 0)
+        return md.Trajectory(xyz, topology, time=np.array(self.time[start:stop]),
+                             unitcell_lengths=cell[:, :3] if has_cell else None,
+                             unitcell_angles=cell[:, 3:] if has_cell else None)
+
+    def iterchunks(self, chunk=1000, atom_indices=None):
+        for start in range(0, self.n_frames, chunk):
+            yield self.slice(start, min(start + chunk, self.n_frames), atom_indices)
+
+def open_store(dcd, top, prefix=None, selection='not water'):
+    """Opens the compact store of a dcd, converting it the first time or when the dcd or the
+    selection changed."""
+    prefix = prefix or f'{os.path.splitext(dcd)[0]}.solute'
+    if not store_exists(prefix, dcd, selection):
+        compact(dcd, top, prefix, selection)
+    return CompactTrajectory(prefix)
+
+def chunk_frames(n_atoms, memory_budget_mb=512, depth=2):
+    """Frames per chunk so that the float32 coordinates of the queued chunks, the one being
+    decoded and the one being analyzed fit in memory_budget_mb."""
+    frame_bytes = n_atoms * 3 * 4
+    return max(1, int(memory_budget_mb * 2**20 // (frame_bytes * (depth + 2))))
+
+_END = object()
+
+def prefetch(iterable, depth=2):
+    """Yields the items of iterable while a background thread produces up to depth items
+    ahead, so reading the next chunks overlaps with analyzing the current one. Errors in
+    the reader are raised in the consumer."""
+    items = queue.Queue(maxsize=depth)
+    stop = threading.Event()
+
+    def put(item):
+        # gives up once the consumer has stopped iterating so the thread never blocks forever
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+            put((_END, None))
+        except Exception as e:
+            put((_END, e))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is _END:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+def read_chunks(dcd, top, compact_store=False, memory_budget_mb=512, depth=2):
+    """Iterates over a trajectory in chunks sized from memory_budget_mb, reading either the
+    compact store or the dcd. With depth > 0 chunks are decoded ahead on a background thread."""
+    if compact_store:
+        store = open_store(dcd, top)
+        chunks = store.iterchunks(chunk_frames(len(store.atom_indices), memory_budget_mb, depth))
+    else:
+        topology = md.load_topology(top)
+        chunks = md.iterload(dcd, top=topology, chunk=chunk_frames(topology.n_atoms, memory_budget_mb, depth))
+    return prefetch(chunks, depth) if depth > 0 else chunks
@@ -5,29 +5,33 @@ from openmm.app import *
 from openmm import *
 from openmm.unit import *
 from sys import stdout
-from openff.toolkit.topology import Molecule
-from openmmforcefields.generators import GAFFTemplateGenerator
-from openff.units.openmm import to_openmm
 
 import numpy as np
-import matplotlib.pyplot as plt 
-import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.colors
 import mdtraj as md
-import argparse
 import multiprocessing as mp
 from tqdm import tqdm
 import json
-from simtk.openmm import app
 import random as random
-import scipy.optimize as optim
-from FastMBAR import *
 import configparser
-
-def get_config():
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from mol_cache import load_molecule
+from profiling import PhaseTimer, timer_from_config
+from trajstore import CompactTrajectory, open_store, store_exists
+from platforms import platform_from_config, platform_metadata, write_metadata
+from relax import relax_and_report
+
+# force group of the umbrella bias, so its energy can be evaluated on its own during exchanges
+BIAS_FORCE_GROUP = 1
+
+# window workers build CUDA contexts, which cannot be used in a child forked from a parent that
+# already initialized CUDA (FastMBAR in wham, pull_chain), so they are always spawned
+spawn = mp.get_context('spawn')
+
+def get_config(filename='umbrella_config.ini'):
     config = configparser.ConfigParser()
-    config.read('umbrella_config.ini')
+    config.read(filename)
     return config
     
 def translate(mol, step, axis='x'):
@@ -125,63 +129,173 @@ def load_mols(filenames, resnames):
     """
     mols = {}
     for filename, resname in zip(filenames, resnames):
-        mol = Molecule.from_file(filename, file_format='sdf')
-        mol.generate_conformers()
-        conf = to_openmm(mol.conformers[0])
-        top = mol.to_topology().to_openmm()
-        top = md.Topology.from_openmm(top)
-        top.residue(0).name = resname
-        top = top.to_openmm()
-        mols[filename[:-4]] = {
-            "mol":mol,
-            "topology": top,
-            "positions": conf,
-            'resname': resname
-        }
+        mols[filename[:-4]] = load_molecule(f'./molecules/{filename}', resname)
     return mols
 
-def write_com(topology_list, successful_sims,target, ribose_type, config):
-    outdir = config.get('Output Parameters','outdir')
+# per frame record of the COM height files read by wham
+COM_DTYPE = np.dtype([('replicate', '<i4'), ('z', '<f4')])
 
-    z_coordinates = []
-
-    top_index = 0
-    for i in successful_sims:
-
-        try:
-            top = md.Topology.from_openmm(topology_list[top_index])
-            traj = md.load(f'traj_{i}_{ribose_type}.dcd', top=top)
-            if ribose_type == 'D':
-                res_indices = traj.topology.select('resname "DRIB"')
-            elif ribose_type == 'L':
-                res_indices = traj.topology.select('resname "LRIB"')
-            
-            res_traj = traj.atom_slice(res_indices)
+def com_file(outdir, target, ribose_type):
+    return f'{outdir}/com_heights_{np.round(target, 3)}_{ribose_type}.npy'
 
-            com = md.compute_center_of_mass(res_traj)
+def load_com(outdir, target, ribose_type):
+    return np.load(com_file(outdir, target, ribose_type), mmap_mode='r')
 
-            z_coordinates.append(com[:, 2])
+def save_com(filename, replicates, z):
+    records = np.empty(len(z), dtype=COM_DTYPE)
+    records['replicate'] = replicates
+    records['z'] = z
+    np.save(filename, records)
 
-            top_index += 1
+def replicate_com(replicate, dcd, atoms, masses, chunk, out_file):
+    """Streams the sugar atoms of one trajectory in chunks and appends the COM height of
+    every frame to a raw COM_DTYPE file, so memory does not grow with trajectory length.
 
-        except Exception as e:
-            print(f"Error loading trajectory traj_{i}_{ribose_type}.dcd:", e)
+    Returns
+    =======
+    n_frames (int)"""
+    prefix = f'{os.path.splitext(dcd)[0]}.solute'
+    masses = masses / np.sum(masses)
+    n_frames = 0
+
+    with open(out_file, 'wb') as out:
+        store = CompactTrajectory(prefix) if store_exists(prefix, dcd) else None
+        # a store written with a narrower selection may lack sugar atoms, those are read from the dcd
+        if store is not None and np.isin(atoms, store.atom_indices).all():
+            store_atoms = np.searchsorted(store.atom_indices, atoms)
+            chunks = (store.xyz[start:start+chunk, store_atoms, 2] for start in range(0, len(store), chunk))
+        else:
+            chunks = dcd_z_chunks(dcd, chunk, atoms)
+
+        for z in chunks:
+            records = np.empty(len(z), dtype=COM_DTYPE)
+            records['replicate'] = replicate
+            records['z'] = z @ masses
+            records.tofile(out)
+            n_frames += len(z)
+
+    return n_frames
+
+def dcd_z_chunks(dcd, chunk, atoms):
+    """Yields the z coordinates (nm) of the given atoms, chunk frames at a time."""
+    with md.formats.DCDTrajectoryFile(dcd) as dcd_file:
+        while True:
+            # the raw dcd reader works in angstrom and only keeps the requested atoms
+            xyz, _, _ = dcd_file.read(n_frames=chunk, atom_indices=atoms)
+            if len(xyz) == 0:
+                return
+            yield xyz[:, :, 2] / 10
 
-    if z_coordinates:
-        z_coordinates = np.concatenate(z_coordinates)
-        np.savetxt(f'{outdir}/com_heights_{np.round(target, 3)}_{ribose_type}.csv', z_coordinates, fmt='%.5f', delimiter=',')
+def write_com(topology_list, successful_sims,target, ribose_type, config):
+    """Writes the sugar COM height of every frame of every replicate of a window to
+    com_heights_<target>_<type>.npy (COM_DTYPE records). Replicates are processed in a
+    worker pool and only the sugar atoms are ever read."""
+    outdir = config.get('Output Parameters','outdir')
+    compact_store = config.get('Output Parameters','compact store', fallback='False') == 'True'
+    workers = int(config.get('Output Parameters','com workers', fallback=4))
+    chunk = int(config.get('Output Parameters','com chunk', fallback=1000))
+
+    jobs = []
+    for i, topology in zip(successful_sims, topology_list):
+        dcd = f'{outdir}/traj_{i}_{ribose_type}_{np.round(target, 3)}.dcd'
+        atoms = sugar_atoms(topology, ribose_type)
+        topology_atoms = list(topology.atoms())
+        masses = np.array([topology_atoms[i].element.mass.value_in_unit(dalton) for i in atoms])
+        if compact_store:
+            #sheet and sugar only, converted once and memory mapped on later passes
+            open_store(dcd, md.Topology.from_openmm(topology))
+        jobs.append((i, dcd, atoms, masses, chunk, f'{outdir}/com_heights_{np.round(target, 3)}_{ribose_type}_{i}.tmp'))
+
+    with mp.Pool(min(workers, max(len(jobs), 1))) as pool:
+        results = [pool.apply_async(replicate_com, job) for job in jobs]
+        counts = []
+        for job, result in zip(jobs, results):
+            try:
+                counts.append((job[-1], result.get()))
+            except Exception as e:
+                print(f"Error loading trajectory {job[1]}:", e)
+
+    counts = [(tmp, n) for tmp, n in counts if n > 0]
+    if counts:
+        #stitch the per replicate files together without loading them all at once
+        out = np.lib.format.open_memmap(com_file(outdir, target, ribose_type), mode='w+', dtype=COM_DTYPE, shape=(sum(n for _, n in counts),))
+        offset = 0
+        for tmp, n in counts:
+            out[offset:offset+n] = np.memmap(tmp, dtype=COM_DTYPE, mode='r', shape=(n,))
+            offset += n
+        out.flush()
+        del out
     else:
         print("No available simulations for this target height")
 
+    for job in jobs:
+        if os.path.exists(job[-1]):
+            os.remove(job[-1])
 
-def simulate(jobid, device_idx, target, end_z, replicate, ribose_type, config):
+def umbrella_bias(sugar_indices, sheet_indices, positions, target, config):
+    """Harmonic restraint on the z coordinate of the sugar center of mass, with an optional
+    flat-bottom wall keeping the sugar laterally above the center of the sheet.
+    Params
+    ======
+    sugar_indices (list) - [(start, stop)] atom ranges of the sugar
+    sheet_indices (list) - [(start, stop)] atom ranges of the sheet, sets the wall center
+    positions     (list) - modeller positions
+    target        (float) - height of the bias in nm
+    config        (configparser.ConfigParser)
 
-    nsteps = int(config.get('Simulation Parameters','number steps'))
-    report = int(config.get('Simulation Parameters','report'))
-    outdir = config.get('Output Parameters','outdir')
+    Returns
+    =======
+    force (openmm.CustomCentroidBondForce) - in BIAS_FORCE_GROUP"""
+    bias_k = float(config.get('Umbrella Setup','bias k', fallback=5000))
+    wall_radius = float(config.get('Umbrella Setup','wall radius', fallback=0))
+    wall_k = float(config.get('Umbrella Setup','wall k', fallback=1000))
+
+    energy = '0.5*j*(z1-target)^2'
+    if wall_radius > 0:
+        energy += ' + 0.5*wall_k*step(r-wall_radius)*(r-wall_radius)^2; r = sqrt((x1-wall_x)^2 + (y1-wall_y)^2)'
+
+    force = CustomCentroidBondForce(1, energy)
+    force.setForceGroup(BIAS_FORCE_GROUP)
+    force.addGlobalParameter('target', target*nanometer)
+    force.addGlobalParameter('j', bias_k*kilojoules_per_mole/nanometer**2)
+
+    bond_parameters = []
+    if wall_radius > 0:
+        sheet = np.array([positions[i].value_in_unit(nanometer) for start, stop in sheet_indices for i in range(start, stop)])
+        force.addGlobalParameter('wall_k', wall_k*kilojoules_per_mole/nanometer**2)
+        force.addGlobalParameter('wall_radius', wall_radius*nanometer)
+        force.addPerBondParameter('wall_x')
+        force.addPerBondParameter('wall_y')
+        bond_parameters = [np.mean(sheet[:, 0]), np.mean(sheet[:, 1])]
+
+    # group weights default to the particle masses
+    force.addGroup([i for start, stop in sugar_indices for i in range(start, stop)])
+    force.addBond([0], bond_parameters)
+
+    return force
+
+def build_simulation(jobid, device_idx, target, end_z, ribose_type, config, timer=None):
+    """Builds, solvates and minimizes one umbrella window.
+    Params
+    ======
+    jobid       (int) - only used for verbose output
+    device_idx  (int) - gpu the context is created on
+    target      (float) - height of the bias in nm
+    end_z       (float) - highest window, sets the box height
+    ribose_type (str) - 'D' or 'L'
+    config      (configparser.ConfigParser)
+    timer       (profiling.PhaseTimer) - optional, records the setup phases
+
+    Returns
+    =======
+    simulation (openmm.app.Simulation), model (openmm.app.Modeller), precision (str)"""
+    from openmmforcefields.generators import GAFFTemplateGenerator
 
-    mols = load_mols(["aD-ribopyro.sdf", 'aL-ribopyro.sdf', 'guanine.sdf', 'cytosine.sdf'], 
-                    ['DRIB', 'LRIB', 'GUA', "CYT"])
+    timer = timer or PhaseTimer()
+
+    with timer.phase('load_mols'):
+        mols = load_mols(["aD-ribopyro.sdf", 'aL-ribopyro.sdf', 'guanine.sdf', 'cytosine.sdf'], 
+                        ['DRIB', 'LRIB', 'GUA', "CYT"])
 
     #generate residue template 
     gaff = GAFFTemplateGenerator(molecules = [mols[name]["mol"] for name in mols.keys()])
@@ -231,10 +345,12 @@ def simulate(jobid, device_idx, target, end_z, replicate, ribose_type, config):
         Vec3(0,0,end_z + 2.5)
     ]
 
-    model.addSolvent(forcefield=forcefield, model='tip3p', boxSize=Vec3(1.5,1.5,end_z + 2.5 ))
+    with timer.phase('addSolvent'):
+        model.addSolvent(forcefield=forcefield, model='tip3p', boxSize=Vec3(1.5,1.5,end_z + 2.5 ))
     model.topology.setPeriodicBoxVectors(box_size)
 
-    system = forcefield.createSystem(model.topology, nonbondedMethod=PME, nonbondedCutoff=0.5*nanometer, constraints=HBonds)
+    with timer.phase('createSystem'):
+        system = forcefield.createSystem(model.topology, nonbondedMethod=PME, nonbondedCutoff=0.5*nanometer, constraints=HBonds)
 
     # create position sheet_restraints (thanks peter eastman https://gist.github.com/peastman/ad8cda653242d731d75e18c836b2a3a5)
     sheet_restraint = CustomExternalForce('k*((x-x0)^2+(y-y0)^2+(z-z0)^2)')
@@ -248,54 +364,437 @@ def simulate(jobid, device_idx, target, end_z, replicate, ribose_type, config):
         for i in range(start, stop):
             sheet_restraint.addParticle(i, model.positions[i])
 
-    #add in bias potential for umbrella sampling 
-    custom_force = CustomExternalForce('0.5*j*((x-x)^2+(y-y)^2+(z-target)^2)')
-    system.addForce(custom_force)
-    custom_force.addGlobalParameter("target", target*nanometer)  
-    custom_force.addGlobalParameter("j", 5000*kilojoules_per_mole/nanometer**2) 
-    custom_force.addPerParticleParameter('z0')
-    custom_force.addPerParticleParameter('x0')
-    custom_force.addPerParticleParameter('y0')
-
-    for start, stop in sugar_indices:
-        for i in range(start, stop):
-            custom_force.addParticle(i, model.positions[i])
+    #add in bias potential for umbrella sampling on the sugar center of mass height, the same CV write_com feeds to wham
+    system.addForce(umbrella_bias(sugar_indices, sheet_indices, model.positions, target, config))
 
     stepsize = 0.001*picoseconds
 
     integrator = LangevinMiddleIntegrator(300*kelvin, 1/picosecond, stepsize)
     model.addExtraParticles(forcefield)
-    platform = Platform.getPlatformByName('CUDA')
-    properties = {'CudaDeviceIndex': str(device_idx), 'CudaPrecision': 'single'}
+    platform, properties, precision = platform_from_config(config, 'Simulation Parameters', device_idx)
 
-    simulation = Simulation(model.topology, system, integrator, platform, properties)
-    simulation.context.setPositions(model.positions)
-    simulation.context.setVelocitiesToTemperature(300*kelvin)
+    with timer.phase('createContext'):
+        simulation = Simulation(model.topology, system, integrator, platform, properties)
+        simulation.context.setPositions(model.positions)
+        simulation.context.setVelocitiesToTemperature(300*kelvin)
     # save pre-minimized positions as pdb
 
-    simulation.minimizeEnergy()
+    relax_and_report(simulation, config, jobid, timer, properties)
+
+    return simulation, model, precision
+
+def seed_files(ribose_type, target, config):
+    outdir = config.get('Output Parameters','outdir')
+    return (f'{outdir}/seed_{ribose_type}.cif',
+            f'{outdir}/seed_{ribose_type}_system.xml',
+            f'{outdir}/seed_{ribose_type}_{np.round(target, 3)}.xml')
+
+def pull_chain(ribose_type, targets, end_z, config):
+    """Builds one system at the lowest window and pulls the sugar through every target height,
+    saving the topology, the serialized system and a State snapshot at each window so the
+    windows can start from an already equilibrated configuration. Run it through
+    run_spawned, the context it builds must not live in the process that starts the windows."""
+    pull_steps = int(config.get('Umbrella Setup','pull steps', fallback=10000))
+    increments = 10
+
+    print(f'Pulling {ribose_type}-ribose from {np.round(targets[0],3)} to {np.round(targets[-1],3)} nm')
+    simulation, model, _ = build_simulation(0, 0, targets[0], end_z, ribose_type, config)
+    topology_file, system_file, _ = seed_files(ribose_type, targets[0], config)
+
+    #residue names like DRIB do not fit in a pdb file, so the topology is stored as PDBx
+    positions = simulation.context.getState(getPositions=True).getPositions()
+    with open(topology_file, 'w') as f:
+        PDBxFile.writeFile(model.topology, positions, f)
+    with open(system_file, 'w') as f:
+        f.write(XmlSerializer.serialize(simulation.system))
+
+    previous = targets[0]
+    for target in tqdm(targets):
+        #move the bias to the next window in small increments instead of one jump
+        for height in np.linspace(previous, target, increments + 1)[1:]:
+            simulation.context.setParameter('target', height)
+            simulation.step(pull_steps // increments)
+        simulation.saveState(seed_files(ribose_type, target, config)[2])
+        previous = target
+
+def run_spawned(function, *args):
+    """Runs function(*args) in a spawned child and waits for it, so any CUDA context it
+    creates never exists in this process."""
+    p = spawn.Process(target=function, args=args)
+    p.start()
+    p.join()
+    if p.exitcode != 0:
+        raise RuntimeError(f'{function.__name__} failed with exit code {p.exitcode}')
+
+def load_seeded_simulation(device_idx, target, ribose_type, config, timer=None, replicate=0):
+    """Rebuilds a window from the files written by pull_chain and equilibrates it briefly.
+    Velocities are redrawn with a seed from the replicate, so replicates of a window start
+    from the same snapshot but follow independent trajectories.
+
+    Returns
+    =======
+    simulation (openmm.app.Simulation), pdbx (openmm.app.PDBxFile), precision (str)"""
+    equilibration = int(config.get('Umbrella Setup','equilibration steps', fallback=5000))
+    topology_file, system_file, state_file = seed_files(ribose_type, target, config)
+    timer = timer or PhaseTimer()
+
+    with timer.phase('loadSeed'):
+        pdbx = PDBxFile(topology_file)
+        with open(system_file) as f:
+            system = XmlSerializer.deserialize(f.read())
+
+    integrator = LangevinMiddleIntegrator(300*kelvin, 1/picosecond, 0.001*picoseconds)
+    platform, properties, precision = platform_from_config(config, 'Simulation Parameters', device_idx)
+
+    with timer.phase('createContext'):
+        simulation = Simulation(pdbx.topology, system, integrator, platform, properties)
+        # the state restores positions, velocities, box vectors and the pull's last target
+        simulation.loadState(state_file)
+        simulation.context.setParameter('target', target)
+        simulation.context.setVelocitiesToTemperature(300*kelvin, replica_seed(target, replicate))
+
+    with timer.phase('equilibrate'):
+        simulation.step(equilibration)
+
+    return simulation, pdbx, precision
+
+def replica_seed(target, replicate):
+    # nonzero, openmm picks a random seed for 0
+    return (replicate * 100003 + int(round(target * 1000))) % (2**31 - 1) + 1
+
+def window_simulation(jobid, device_idx, target, end_z, ribose_type, config, timer=None, replicate=0):
+    """Starts from the pulled snapshot when warm starts are enabled, otherwise builds from scratch."""
+    warm_start = config.get('Umbrella Setup','warm start', fallback='False') == 'True'
+    if warm_start and os.path.exists(seed_files(ribose_type, target, config)[2]):
+        return load_seeded_simulation(device_idx, target, ribose_type, config, timer, replicate)
+    return build_simulation(jobid, device_idx, target, end_z, ribose_type, config, timer)
+
+def simulate(jobid, device_idx, target, end_z, replicate, ribose_type, config):
+
+    nsteps = int(config.get('Simulation Parameters','number steps'))
+    report = int(config.get('Simulation Parameters','report'))
+    outdir = config.get('Output Parameters','outdir')
+
+    #the timings are flushed on exit, also when the replicate fails
+    with timer_from_config(config, 'Output Parameters', f'{replicate}_{ribose_type}_{np.round(target, 3)}', outdir) as timer:
+        simulation, model, precision = window_simulation(jobid, device_idx, target, end_z, ribose_type, config, timer, replicate)
+        stepsize = simulation.integrator.getStepSize()
+
+        metadata = platform_metadata(simulation.context, precision)
+        metadata['target'] = target
+        write_metadata(f'{outdir}/metadata_{replicate}_{ribose_type}_{np.round(target, 3)}.json', metadata)
 
-    # PDBFile.writeFile(simulation.topology, simulation.context.getState(getPositions=True).getPositions(), open(f"umbrella_first_frame_{np.round(target,3)}.pdb", 'w'))
-    # simulation.reporters.append(PDBReporter(f'umbrella_{np.round(target,3)}.pdb', report))
+        # PDBFile.writeFile(simulation.topology, simulation.context.getState(getPositions=True).getPositions(), open(f"umbrella_first_frame_{np.round(target,3)}.pdb", 'w'))
+        # simulation.reporters.append(PDBReporter(f'umbrella_{np.round(target,3)}.pdb', report))
 
-    simulation.reporters.append(StateDataReporter(stdout, report, step=True,
-        potentialEnergy=True, temperature=True, speed=True, time=True))
+        simulation.reporters.append(StateDataReporter(stdout, report, step=True,
+            potentialEnergy=True, temperature=True, speed=True, time=True))
     
-    #need to store the topologies because every sim has a slighlty different number of waters
-    model_top = model.getTopology()
-
-    file_handle = open(f"{outdir}/traj_{replicate}_{ribose_type}.dcd", 'bw')
-    dcd_file = DCDFile(file_handle, model.topology, dt=stepsize)
-    for step in range(0,nsteps, report):
-        simulation.step(report)
-        state = simulation.context.getState(getPositions=True)
-        positions = state.getPositions()
-        dcd_file.writeModel(positions)
-    file_handle.close()
+        #need to store the topologies because every sim has a slighlty different number of waters
+        model_top = model.getTopology()
+
+        #windows can run concurrently, so the target height is part of the file name
+        file_handle = open(f"{outdir}/traj_{replicate}_{ribose_type}_{np.round(target, 3)}.dcd", 'bw')
+        dcd_file = DCDFile(file_handle, model.topology, dt=stepsize)
+        for step in range(0,nsteps, report):
+            with timer.phase('step'):
+                simulation.step(report)
+            with timer.phase('write_trajectory'):
+                state = simulation.context.getState(getPositions=True)
+                positions = state.getPositions()
+                dcd_file.writeModel(positions)
+        file_handle.close()
 
     return model_top
 
+def run_window(jobid, device_idx, target, end_z, ribose_type, config):
+    """Runs every replicate of one umbrella window and writes its COM heights."""
+    nsims = int(config.get('Simulation Parameters','number sims'))
+    outdir = config.get('Output Parameters','outdir')
+
+    #run_windows uses the heights file to tell which windows succeeded, so drop results of earlier runs
+    if os.path.exists(com_file(outdir, target, ribose_type)):
+        os.remove(com_file(outdir, target, ribose_type))
+
+    topology_list = []
+    successful_sims = []
+
+    for replicate in range(1, nsims + 1):
+        print(f'This is replicate {replicate} of target height {np.round(target,3)} nm for {ribose_type}-ribose')
+        try:
+            topology_list.append(simulate(jobid, device_idx, target, end_z, replicate, ribose_type, config))
+            successful_sims.append(replicate)
+        except KeyboardInterrupt:
+            print('Keyboard Interrupt')
+            return
+        except:
+            print('Particle Coordinate is NaN')
+
+    try:
+        write_com(topology_list, successful_sims, target, ribose_type, config)
+    except Exception as e:
+        print(e)
+        print('No available simulations for this target height')
+
+def run_windows(ribose_type, targets, end_z, config):
+    """Runs the independent umbrella windows, packing 'number processes' concurrent
+    windows onto every gpu since a single small box does not saturate a device.
+
+    Returns
+    =======
+    target_list (list) - windows with at least one successful replicate"""
+    outdir = config.get('Output Parameters','outdir')
+    gpus = int(config.get('Umbrella Setup','number gpus'))
+    per_gpu = int(config.get('Umbrella Setup','number processes'))
+
+    pending = list(enumerate(targets))
+    running = []
+
+    with tqdm(total=len(targets)) as pbar:
+        while pending or running:
+            for p, device in list(running):
+                if not p.is_alive():
+                    p.join()
+                    running.remove((p, device))
+                    pbar.update(1)
+
+            load = [sum(device == gpu for _, device in running) for gpu in range(gpus)]
+            device = int(np.argmin(load))
+
+            if pending and load[device] < per_gpu:
+                jobid, target = pending.pop(0)
+                p = spawn.Process(target=run_window, args=(jobid, device, target, end_z, ribose_type, config))
+                p.start()
+                running.append((p, device))
+            else:
+                time.sleep(1)
+
+    return [target for target in targets if os.path.exists(com_file(outdir, target, ribose_type))]
+
+def packing_throughput(jobid, device_idx, target, end_z, ribose_type, steps, barrier, results, config):
+    #every outcome is reported, a child that dies quietly would leave the parent and the other children waiting
+    try:
+        simulation, _, _ = build_simulation(jobid, device_idx, target, end_z, ribose_type, config)
+        simulation.step(100)
+
+        #start timing once every context is built so they actually share the device
+        barrier.wait()
+        start = time.perf_counter()
+        simulation.step(steps)
+        elapsed = time.perf_counter() - start
+
+        dt = simulation.integrator.getStepSize().value_in_unit(nanosecond)
+        results.put((jobid, steps * dt / elapsed * 86400, None))
+    except Exception as e:
+        barrier.abort()
+        results.put((jobid, None, repr(e)))
+
+def packing_results(processes, results, timeout):
+    """ns/day of every process, or None with the reason when any of them fails, dies or
+    does not report within timeout seconds."""
+    import queue
+
+    per_context = []
+    deadline = time.monotonic() + timeout
+    while len(per_context) < len(processes):
+        try:
+            jobid, rate, error = results.get(timeout=min(5, max(deadline - time.monotonic(), 0)))
+        except queue.Empty:
+            dead = [p.exitcode for p in processes if p.exitcode not in (None, 0)]
+            if dead:
+                return None, f'process exited with code {dead[0]}'
+            if time.monotonic() > deadline:
+                return None, f'no result within {timeout} s'
+            continue
+        if error is not None:
+            return None, f'process {jobid} failed: {error}'
+        per_context.append(rate)
+    return per_context, None
+
+def benchmark_packing(max_processes, config):
+    """Measures aggregate ns/day for 1..max_processes concurrent windows on gpu 0. Process
+    counts where any window fails (out of memory, NaN) are reported and skipped.
+
+    Returns
+    =======
+    best (int) - number of processes per gpu with the highest aggregate throughput, None if every count failed"""
+    outdir = config.get('Output Parameters','outdir')
+    start_z = float(config.get('Umbrella Setup','start z'))
+    end_z = float(config.get('Umbrella Setup','end z'))
+    steps = int(config.get('Umbrella Setup','benchmark steps', fallback=5000))
+    timeout = float(config.get('Umbrella Setup','benchmark timeout', fallback=3600))
+
+    throughput = {}
+    failed = {}
+    for n in range(1, max_processes + 1):
+        barrier = spawn.Barrier(n)
+        results = spawn.Queue()
+        processes = [spawn.Process(target=packing_throughput, args=(i, 0, start_z, end_z, 'D', steps, barrier, results, config)) for i in range(n)]
+        for p in processes:
+            p.start()
+        per_context, error = packing_results(processes, results, timeout)
+        if error is not None:
+            # releases children still waiting at the barrier before they are stopped
+            barrier.abort()
+            for p in processes:
+                if p.is_alive():
+                    p.terminate()
+        for p in processes:
+            p.join()
+
+        if error is not None:
+            failed[n] = error
+            print(f'{n} processes: failed, {error}')
+            continue
+
+        throughput[n] = {'aggregate ns/day': float(np.sum(per_context)), 'ns/day per context': float(np.mean(per_context))}
+        print(f"{n} processes: {throughput[n]['aggregate ns/day']:.1f} ns/day total, {throughput[n]['ns/day per context']:.1f} ns/day each")
+
+    best = max(throughput, key=lambda n: throughput[n]['aggregate ns/day']) if throughput else None
+    if best is None:
+        print('Every process count failed')
+    else:
+        print(f'Best throughput with {best} processes per gpu')
+
+    with open(f'{outdir}/packing_benchmark.json', 'w') as benchmark_file:
+        json.dump({'best': best, 'steps': steps, 'throughput': throughput, 'failed': failed}, benchmark_file, indent=2)
+
+    return best
+
+def window_targets(start_z, end_z, dz):
+    targets = []
+    target = start_z
+    while target < end_z:
+        targets.append(target)
+        target += dz
+    return targets
+
+def sugar_atoms(topology, ribose_type):
+    resname = 'DRIB' if ribose_type == 'D' else 'LRIB'
+    return np.array([atom.index for atom in topology.atoms() if atom.residue.name == resname])
+
+def bias_energy(simulation, target):
+    """Umbrella energy (kJ/mol) of the current configuration for a given target height."""
+    simulation.context.setParameter('target', target)
+    state = simulation.context.getState(getEnergy=True, groups={BIAS_FORCE_GROUP})
+    return state.getPotentialEnergy().value_in_unit(kilojoule_per_mole)
+
+def attempt_exchanges(simulations, replica_targets, window_of, targets, kbT, attempts, accepted, offset):
+    """Tries to swap the bias targets of neighbouring windows (Metropolis criterion).
+    Params
+    ======
+    simulations     (list) - one simulation per replica
+    replica_targets (list) - current target of each replica, updated in place
+    window_of       (list) - current window index of each replica, updated in place
+    targets         (list) - target height of each window
+    kbT             (float) - kJ/mol
+    attempts, accepted (np.array) - per window pair counters, updated in place
+    offset          (int) - 0 or 1, alternates even and odd pairs between attempts"""
+    replica_at = {window: replica for replica, window in enumerate(window_of)}
+
+    for window in range(offset, len(targets) - 1, 2):
+        i, j = replica_at[window], replica_at[window + 1]
+        t_i, t_j = targets[window], targets[window + 1]
+
+        u_ii = bias_energy(simulations[i], t_i)
+        u_jj = bias_energy(simulations[j], t_j)
+        u_ij = bias_energy(simulations[i], t_j)
+        u_ji = bias_energy(simulations[j], t_i)
+
+        delta = (u_ij + u_ji - u_ii - u_jj) / kbT
+        attempts[window] += 1
+
+        if delta <= 0 or np.random.uniform() < np.exp(-delta):
+            accepted[window] += 1
+            window_of[i], window_of[j] = window + 1, window
+            replica_targets[i], replica_targets[j] = t_j, t_i
+
+        simulations[i].context.setParameter('target', replica_targets[i])
+        simulations[j].context.setParameter('target', replica_targets[j])
+
+def replica_exchange(ribose_type, targets, end_z, config):
+    """Hamiltonian replica exchange umbrella sampling. Every window runs at the same time and
+    neighbouring windows periodically try to swap their bias target. The sugar height is
+    written per window in the same format as write_com so wham can be used unchanged.
+
+    Returns
+    =======
+    targets (list) - the windows that were sampled"""
+    nsteps = int(config.get('Simulation Parameters','number steps'))
+    report = int(config.get('Simulation Parameters','report'))
+    outdir = config.get('Output Parameters','outdir')
+    gpus = int(config.get('Umbrella Setup','number gpus'))
+    exchange = int(config.get('Umbrella Setup','exchange interval', fallback=report))
+
+    if exchange % report != 0:
+        raise ValueError('exchange interval has to be a multiple of the report interval')
+
+    kbT = (BOLTZMANN_CONSTANT_kB * 300 * kelvin * AVOGADRO_CONSTANT_NA).value_in_unit(kilojoule_per_mole)
+
+    simulations, dcd_files, file_handles, sugars, masses = [], [], [], [], []
+    for window, target in enumerate(targets):
+        print(f'Building replica {window} at target height {np.round(target,3)} nm for {ribose_type}-ribose')
+        simulation, model, precision = window_simulation(window, window % gpus, target, end_z, ribose_type, config)
+
+        metadata = platform_metadata(simulation.context, precision)
+        metadata['target'] = target
+        write_metadata(f'{outdir}/metadata_remd_{window}_{ribose_type}.json', metadata)
+
+        file_handle = open(f'{outdir}/traj_remd_{window}_{ribose_type}.dcd', 'bw')
+        atoms = sugar_atoms(model.topology, ribose_type)
+
+        simulations.append(simulation)
+        file_handles.append(file_handle)
+        dcd_files.append(DCDFile(file_handle, model.topology, dt=simulation.integrator.getStepSize()))
+        sugars.append(atoms)
+        masses.append(np.array([simulation.system.getParticleMass(int(i)).value_in_unit(dalton) for i in atoms]))
+
+    n_windows = len(targets)
+    window_of = list(range(n_windows))
+    replica_targets = list(targets)
+    heights = [[] for _ in targets]
+    replicas = [[] for _ in targets]
+    window_history = []
+    attempts, accepted = np.zeros(n_windows - 1), np.zeros(n_windows - 1)
+
+    # contexts on the same or different gpus are stepped from separate threads, openmm releases the GIL while stepping
+    with ThreadPoolExecutor(max_workers=n_windows) as pool:
+        for step in tqdm(range(report, nsteps + 1, report)):
+            list(pool.map(lambda simulation: simulation.step(report), simulations))
+
+            for replica, simulation in enumerate(simulations):
+                positions = simulation.context.getState(getPositions=True).getPositions(asNumpy=True)
+                dcd_files[replica].writeModel(positions)
+
+                z = positions.value_in_unit(nanometer)[sugars[replica], 2]
+                heights[window_of[replica]].append(np.sum(z * masses[replica]) / np.sum(masses[replica]))
+                replicas[window_of[replica]].append(replica)
+            window_history.append(list(window_of))
+
+            if step % exchange == 0 and n_windows > 1:
+                attempt_exchanges(simulations, replica_targets, window_of, targets, kbT, attempts, accepted, (step // exchange) % 2)
+
+    for file_handle in file_handles:
+        file_handle.close()
+
+    for window, target in enumerate(targets):
+        save_com(com_file(outdir, target, ribose_type), replicas[window], heights[window])
+
+    # window index of every replica at every saved frame, to demultiplex the replica trajectories
+    np.savetxt(f'{outdir}/remd_windows_{ribose_type}.csv', np.array(window_history), fmt='%d', delimiter=',')
+
+    ratio = np.divide(accepted, attempts, out=np.zeros_like(accepted), where=attempts > 0)
+    with open(f'{outdir}/exchange_{ribose_type}.csv', 'w') as exchange_file:
+        exchange_file.write('target low,target high,attempts,accepted,acceptance\n')
+        for window in range(n_windows - 1):
+            exchange_file.write(f'{targets[window]:.3f},{targets[window+1]:.3f},{int(attempts[window])},{int(accepted[window])},{ratio[window]:.3f}\n')
+            print(f'Exchange {np.round(targets[window],3)} <-> {np.round(targets[window+1],3)} nm: acceptance {ratio[window]:.3f}')
+
+    return targets
+
 def wham(ribose_type, config):
+    from FastMBAR import FastMBAR
+
     outdir = config.get('Output Parameters','outdir')
     heights = []
     num_conf = []
@@ -303,7 +802,7 @@ def wham(ribose_type, config):
     target_list = np.loadtxt(f'{outdir}/heights_{ribose_type}.csv', delimiter=',')
 
     for height_index in target_list:
-        height = np.loadtxt(f'{outdir}/com_heights_{np.round(height_index,3)}_{ribose_type}.csv', delimiter = ',')
+        height = load_com(outdir, height_index, ribose_type)['z']
         heights.append(height)
         num_conf.append(len(height))
 
@@ -312,19 +811,20 @@ def wham(ribose_type, config):
     N = len(heights)
     
     ##compute reduced energy matrix A
+    #the bias acts on the sugar center of mass height, which is exactly the CV in the com_heights files
     A = np.zeros((len(target_list),N))
-    K = 5000
+    K = float(config.get('Umbrella Setup','bias k', fallback=5000))
     T = 300 * kelvin
-    kbT = BOLTZMANN_CONSTANT_kB * 298.15 * kelvin * AVOGADRO_CONSTANT_NA
+    kbT = BOLTZMANN_CONSTANT_kB * T * AVOGADRO_CONSTANT_NA
     kbT = kbT.value_in_unit(kilojoule_per_mole)
 
     for height_index in range(len(target_list)):
         current_height = target_list[height_index]
-        diff = np.abs(heights - current_height)
-        diff = np.minimum(diff, 2*np.pi -diff)
+        diff = heights - current_height
         A[height_index,:] = 0.5*K*diff**2/kbT
     
-    fastmbar = FastMBAR(energy=A, num_conf=num_conf, cuda=True, verbose=True)
+    cuda = config.get('Umbrella Setup','wham cuda', fallback='True') == 'True'
+    fastmbar = FastMBAR(energy=A, num_conf=num_conf, cuda=cuda, verbose=True)
     
     #compute reduced energy matrix B
     L = len(target_list)
@@ -347,71 +847,58 @@ def wham(ribose_type, config):
 
     return height_PMF, calc_PMF
 
-def main():
-    config = get_config()
-    nsims = int(config.get('Simulation Parameters','number sims'))
-    nsteps = int(config.get('Simulation Parameters','number steps'))
-    report = int(config.get('Simulation Parameters','report'))
+def main(config_file='umbrella_config.ini', benchmark_packing_max=None):
+    config = get_config(config_file)
+
+    if benchmark_packing_max:
+        benchmark_packing(benchmark_packing_max, config)
+        return
 
-    gpus = int(config.get('Umbrella Setup','number gpus'))
     start_z = float(config.get('Umbrella Setup','start z'))
     end_z = float(config.get('Umbrella Setup','end z'))
     dz = float(config.get('Umbrella Setup','dz'))
-    jobs = 0
+    mode = config.get('Umbrella Setup','mode', fallback='independent')
+    warm_start = config.get('Umbrella Setup','warm start', fallback='False') == 'True'
+    outdir = config.get('Output Parameters','outdir')
     riboses = ['D','L']
-    target = start_z
 
     PMF = {}
 
     for i in riboses:
         ribose_type = i
-        target=start_z
-        target_list = []
-
-        while target < end_z:
-            replicate = 1
-            topology_list = []
-            successful_sims = []
-
-            while replicate <= nsims:
-                print(f'This is replicate {replicate} of target height {np.round(target,3)} nm for {ribose_type}-ribose')
-                try:
-                    topology_list.append(simulate(jobs, jobs%gpus, target, end_z, replicate, ribose_type, config))
-                    successful_sims.append(replicate)
-                    target_list.append(target)
-                except KeyboardInterrupt:
-                    print('Keyboard Interrupt')
-                    return
-                except:
-                    print('Particle Coordinate is NaN')
-                replicate+=1
 
-            try:
-                write_com(topology_list, successful_sims, target, ribose_type, config)
-            except Exception as e:
-                print(e)
-                print('No available simulations for this target height')
+        if warm_start:
+            run_spawned(pull_chain, ribose_type, window_targets(start_z, end_z, dz), end_z, config)
+
+        if mode == 'replica exchange':
+            target_list = replica_exchange(ribose_type, window_targets(start_z, end_z, dz), end_z, config)
+        else:
+            target_list = run_windows(ribose_type, window_targets(start_z, end_z, dz), end_z, config)
 
-            target += dz
-        target_list = list(set(target_list))
-        np.savetxt(f'heights_{ribose_type}.csv',target_list)
+        target_list = sorted(set(target_list))
+        np.savetxt(f'{outdir}/heights_{ribose_type}.csv',target_list)
     
         height_key = f'{ribose_type}_height_PMF'
         calc_key = f'{ribose_type}_calc_PMF'
 
         PMF[height_key], PMF[calc_key] = wham(ribose_type ,config)
     
+    from rendering import pyplot, save_figure
+
+    plt = pyplot()
     keys = list(PMF.keys())
     print(keys)
     values = list(PMF.values())
 
+    fig, ax = plt.subplots()
     for i in range(0,len(keys),2):
-        plt.plot(values[i],values[i+1], linewidth=1, label=f'{keys[i][0]}-Ribose')
+        ax.plot(values[i],values[i+1], linewidth=1, label=f'{keys[i][0]}-Ribose')
 
-    plt.xlabel('height above sheet (nm)')
-    plt.ylabel('PMF (kJ/mol)')
-    plt.legend()
-    plt.show()
+    ax.set_xlabel('height above sheet (nm)')
+    ax.set_ylabel('PMF (kJ/mol)')
+    ax.legend()
+    save_figure(fig, f'{outdir}/pmf.png')
+    print('Saved', f'{outdir}/pmf.png')
 
 if __name__ == "__main__":
     main()
\ No newline at end of file